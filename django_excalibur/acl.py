@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from excalibur.exceptions import PluginRunnerError
+from excalibur.utils import all_sources_or_sources_list_or_list
+
+"""
+Index of the acl configuration
+
+The acl lists the allowed methods by project, establishment and ressource,
+or by establishment and ressource without projects. The index is built once
+by configuration and answers like the excalibur acl check, without walking
+the lists.
+
+"""
+
+
+def iter_entries(acl):
+    """ the (project, source, ressource) and methods of the acl """
+    for key, value in (acl or {}).items():
+        for name, entry in (value or {}).items():
+            if isinstance(entry, list):
+                # no project
+                yield (None, key, name), entry
+            elif isinstance(entry, dict):
+                for ressource, methods in entry.items():
+                    if isinstance(methods, list):
+                        yield (key, name, ressource), methods
+
+
+class AclIndex(object):
+
+    """
+    frozen index of the acl, the allowed (project, source, ressource,
+    method) and the (project, source, ressource) entries
+    """
+
+    def __init__(self, acl):
+        entries, allowed = set(), set()
+        for entry, methods in iter_entries(acl):
+            entries.add(entry)
+            allowed.update(entry + (method,) for method in methods)
+        self.entries = frozenset(entries)
+        self.allowed = frozenset(allowed)
+        self.has_default = 'default' in (acl or {})
+
+    def is_allowed(self, project, targets, ressource, method):
+        """
+        check a method for the targeted sources, all of them must be in the
+        acl and one of them must allow the method. Without project, the
+        "default" project is used if the acl has one.
+        """
+        project = project or ('default' if self.has_default else None)
+        keys = [(project, target, ressource) for target in targets]
+        return all(key in self.entries for key in keys) and \
+            any(key + (method,) in self.allowed for key in keys)
+
+
+def get_targets(plugin_runner, project, source):
+    """
+    the sources checked by the acl for a query source ("all", a list or a
+    source), None if the runner does not know the project
+    """
+    try:
+        sources = plugin_runner.sources(None, project)
+    except PluginRunnerError:
+        return None
+    return all_sources_or_sources_list_or_list(source, sources)
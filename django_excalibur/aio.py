@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import functools
+import time
+from django.conf import settings
+from excalibur.core import PluginsRunner
+from excalibur.exceptions import ExcaliburError
+from excalibur.loader import PluginLoader
+from excalibur.utils import format_error, plugin_data_format,\
+    separator_contained, set_plugin_name
+from . import metrics
+from .deadline import DeadlineExceededError, remaining, use_deadline
+from .decorators import count_skipped, skip_reason
+from .middleware import ExcaliburMiddleware
+from .runners import PluginTimeoutError, mark_optional, plugin_key
+from .utils import ExcaliburAttack, generate_client_and_get_data
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    markcoroutinefunction = None
+
+"""
+Asynchronous excalibur middleware, for the ASGI deployments (Django 3.1+,
+python 3.5+, this module is never imported by the others)::
+
+    MIDDLEWARE = [
+        'django_excalibur.aio.AsyncExcaliburMiddleware',
+        ...
+    ]
+
+The token, configuration and checks are handled in a thread, like the
+database work of Django. The plugins of a query are then run together on
+the event loop: the plugin methods which are coroutine functions are
+awaited, the others are called in a thread of the runner.
+The async plugins get their SPORE data with
+async_generate_client_and_get_data.
+
+With a sync get_response, it works like ExcaliburMiddleware.
+
+"""
+
+
+def in_thread(func, *args):
+    """ run a blocking function in a thread, the database one if any """
+    if sync_to_async is not None:
+        return sync_to_async(func)(*args)
+    return asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(func, *args))
+
+
+async def async_generate_client_and_get_data(spore, token, method_name,
+                                             method_args, deadline=None):
+    """
+    get data from a method of a pooled britney client without blocking the
+    event loop, the request is sent from a thread
+    """
+    def get_data():
+        with use_deadline(deadline):
+            return generate_client_and_get_data(spore, token, method_name,
+                                                method_args)
+
+    return await asyncio.get_event_loop().run_in_executor(None, get_data)
+
+
+def run_checks(plugin_runner, query):
+    """ run the excalibur checks of the query, without the plugins """
+    PluginsRunner.check_all(lambda runner, query: None)(plugin_runner, query)
+
+
+async def call_plugin(plugin_runner, method, name, query, params):
+    """
+    await an async plugin method for each parameters set, like the sync
+    plugins, and return its own data and errors
+    """
+    data, errors = collections.OrderedDict(), collections.OrderedDict()
+    plugin_name = set_plugin_name(name)
+    start = time.perf_counter()
+
+    for index, parameters in enumerate(params):
+        plugin_data = None
+        try:
+            plugin_data = await method(
+                parameters, query.arguments, data=data, source=query.source,
+                project=query.project)
+        except Exception as e:
+            errors[plugin_name] = format_error(query, e, index)
+        data = plugin_data_format(plugin_data, data,
+                                  separator_contained(name), name,
+                                  plugin_name)
+
+    elapsed = time.perf_counter() - start
+    metrics.timing('excalibur.plugin', elapsed, plugin=plugin_name,
+                   method=query.function_name)
+    timings = getattr(query, 'timings', None)
+    if timings is not None:
+        timings.add_plugin(name, elapsed)
+    for error in errors.values():
+        metrics.increment('excalibur.plugin.errors', plugin=plugin_name,
+                          error=error['error'])
+
+    key = plugin_key(name)
+    return ({key: data[key]} if key in data else {},
+            mark_optional(errors, params))
+
+
+async def run_plugin(plugin_runner, loader, name, query, params):
+    """
+    run one plugin of the query, at most until the plugin timeout or the
+    deadline
+    """
+    plugin = loader.get_plugin(set_plugin_name(name))
+    method = getattr(plugin, query.function_name, None)
+    if asyncio.iscoroutinefunction(method):
+        run = call_plugin(plugin_runner, method, name, query, params)
+    else:
+        # a blocking plugin, in a thread like the concurrent runner
+        run = asyncio.get_event_loop().run_in_executor(
+            plugin_runner.executor, plugin_runner.run_plugin, loader, name,
+            query, params, {})
+
+    deadline = getattr(query, 'deadline', None)
+    timeouts = [timeout for timeout in (plugin_runner.plugin_timeout,
+                                        remaining(deadline))
+                if timeout is not None]
+    try:
+        return await asyncio.wait_for(
+            run, min(timeouts) if timeouts else None)
+    except asyncio.TimeoutError:
+        return {}, plugin_runner.plugin_error(
+            name, query, params,
+            DeadlineExceededError("no answer before the deadline")
+            if remaining(deadline) == 0 else
+            PluginTimeoutError("no answer after %ss" %
+                               plugin_runner.plugin_timeout))
+
+
+async def run_query(plugin_runner, query):
+    """
+    run the checks of the query, then all its plugins together. The data
+    and errors are in the plugins order.
+    """
+    await in_thread(run_checks, plugin_runner, query)
+
+    loader = PluginLoader(plugin_runner.plugins_module)
+    plugins = plugin_runner.plugins(*query("plugins"))
+    results = await asyncio.gather(*[
+        run_plugin(plugin_runner, loader, name, query, params)
+        for name, params in plugins.items()])
+
+    data, errors = collections.OrderedDict(), collections.OrderedDict()
+    for plugin_data, plugin_errors in results:
+        data.update(plugin_data)
+        errors.update(plugin_errors)
+    return data, errors
+
+
+async def run_batch(excalibur, plugin_runner):
+    """
+    run the queries of the ids of the batch, at most
+    EXCALIBUR_BATCH_MAX_WORKERS at a time, an excalibur error of a query is
+    an error of its id only
+    """
+    semaphore = asyncio.Semaphore(getattr(
+        settings, 'EXCALIBUR_BATCH_MAX_WORKERS', 4))
+
+    async def run(id):
+        async with semaphore:
+            query = excalibur.make_batch_query(id)
+            try:
+                return await run_query(plugin_runner, query)
+            except ExcaliburError as e:
+                return {}, {'excalibur': format_error(query, e, None)}
+
+    results = await asyncio.gather(*[run(id) for id in excalibur.ids])
+    return collections.OrderedDict(zip(excalibur.ids, results))
+
+
+class AsyncExcaliburMiddleware(ExcaliburMiddleware):
+
+    """ The excalibur middleware, sync and async """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # django awaits the middleware
+            if markcoroutinefunction is not None:
+                markcoroutinefunction(self)
+            else:
+                self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        reason = skip_reason(request, response)
+        if reason:
+            count_skipped(reason)
+            return response
+        return await self.aprocess_response(request, response)
+
+    async def aprocess_response(self, request, response):
+        """ process_response with the plugins on the event loop """
+        start = time.perf_counter()
+        excalibur = ExcaliburAttack(request, response)
+        try:
+            prepared = await in_thread(self.prepare, excalibur, start)
+
+            if prepared:
+                plugin_runner, merge = prepared
+                if excalibur.ids:
+                    results = await run_batch(excalibur, plugin_runner)
+                else:
+                    results = await run_query(plugin_runner,
+                                              excalibur.make_query())
+                response = self.aggregate(excalibur, merge, results)
+
+        except ExcaliburError as e:
+            response = self.handle_error(e, response)
+
+        return self.finish(excalibur, response, start)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from django.conf import settings
+from excalibur.utils import PLUGIN_NAME_SEPARATOR, set_plugin_name,\
+    separator_contained
+from .cache import get_cache
+
+"""
+Circuit breakers of the plugins, by plugin and source
+
+A plugin which fails EXCALIBUR_BREAKER_FAILURES times in a row for a source
+(an error, or an answer slower than the plugin timeout) is skipped during
+EXCALIBUR_BREAKER_RESET_TIMEOUT seconds, then one query tries it again.
+Without EXCALIBUR_BREAKER_FAILURES, the plugins are always called.
+
+A skipped plugin is listed in the X-Excalibur-Partial header and the
+referentiel data are served without it, or with its last good data for the
+same query if they are kept EXCALIBUR_BREAKER_FALLBACK_TTL seconds.
+
+"""
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+LAST_GOOD_SUFFIX = ':last-good'
+
+breakers = {}
+lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+
+    """
+    closed: the plugin is called, open: it is skipped, half-open: one
+    query tries it again
+    """
+
+    def __init__(self, max_failures, reset_timeout):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ check if the plugin can be called """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            # a lost try is done again after the same timeout
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.max_failures:
+                self.state = OPEN
+                self.opened_at = time.time()
+
+
+def breaker_key(plugin_name, query):
+    """ the plugin and source of a plugin of a query """
+    if separator_contained(plugin_name):
+        source = plugin_name.split(PLUGIN_NAME_SEPARATOR, 1)[0]
+    else:
+        source = query.source
+    return set_plugin_name(plugin_name), source
+
+
+def get_breaker(plugin_name, query):
+    """ the breaker of a plugin of a query, None without breakers """
+    max_failures = getattr(settings, 'EXCALIBUR_BREAKER_FAILURES', None)
+    if not max_failures:
+        return None
+    key = breaker_key(plugin_name, query)
+    with lock:
+        breaker = breakers.get(key)
+        if breaker is None:
+            breaker = breakers[key] = CircuitBreaker(
+                max_failures,
+                getattr(settings, 'EXCALIBUR_BREAKER_RESET_TIMEOUT', 30))
+    return breaker
+
+
+def keep_last_good(key, data):
+    """ keep the data of a plugin result for the fallback """
+    ttl = getattr(settings, 'EXCALIBUR_BREAKER_FALLBACK_TTL', None)
+    if ttl:
+        get_cache().set(key + LAST_GOOD_SUFFIX, data, ttl)
+
+
+def last_good(key):
+    """ the last good data of a plugin result, {} if unknown """
+    if not getattr(settings, 'EXCALIBUR_BREAKER_FALLBACK_TTL', None):
+        return {}
+    return get_cache().get(key + LAST_GOOD_SUFFIX) or {}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import time
+from django.conf import settings
+from django.core.cache import caches
+from . import deadline
+
+"""
+Cache of the plugins results
+
+A plugin is cached when all its parameters sets declare a "cache ttl" in the
+sources configuration, for all its methods or by method::
+
+    Ldapuds:
+        -   spore: http://myurl/description.json
+            token: S3CR3T
+            cache ttl:
+                default: 300
+                members_method2: 60
+
+"""
+
+CACHE_KEY_PREFIX = 'django_excalibur:plugin:'
+TTL_KEY = 'cache ttl'
+
+
+def get_cache():
+    """ the cache shared by the excalibur processes """
+    return caches[getattr(settings, 'EXCALIBUR_CACHE_ALIAS', 'default')]
+
+
+def get_ttl(parameters_sets, function_name):
+    """
+    get the cache ttl of a plugin method, None if it is not cached
+    """
+    ttls = []
+    for parameters in parameters_sets or []:
+        ttl = parameters.get(TTL_KEY) if isinstance(parameters, dict) \
+            else None
+        if isinstance(ttl, dict):
+            ttl = ttl.get(function_name, ttl.get('default'))
+        if not ttl:
+            return None
+        ttls.append(ttl)
+    return min(ttls) if ttls else None
+
+
+def result_key(plugin_name, query):
+    """
+    the cache key of a plugin result for a query. The signature is part of
+    the key, a result is never shared between two tokens.
+    """
+    to_hash = json.dumps(
+        [plugin_name, query.project, query.source, query.ressource,
+         query.method, query.signature, query.arguments], sort_keys=True)
+    return CACHE_KEY_PREFIX + hashlib.sha1(
+        to_hash.encode('utf-8')).hexdigest()
+
+
+def cached_result(key, ttl, compute):
+    """
+    get a plugin result from the cache or compute it.
+    compute returns the data and errors of the plugin, the data are cached
+    only without errors. Only one process computes a missing result, the
+    others wait for it at most EXCALIBUR_CACHE_LOCK_TIMEOUT seconds, and
+    never after the deadline of the thread (DeadlineExceededError).
+    """
+    cache = get_cache()
+    data = cache.get(key)
+    if data is not None:
+        return data, {}
+
+    lock_key = key + ':lock'
+    lock_timeout = getattr(settings, 'EXCALIBUR_CACHE_LOCK_TIMEOUT', 10)
+    owner = cache.add(lock_key, 1, lock_timeout)
+    if not owner:
+        # another process computes the result, wait for it
+        end = time.time() + deadline.timeout(lock_timeout)
+        while time.time() < end and cache.get(lock_key) is not None:
+            time.sleep(min(0.05, max(0, end - time.time())))
+            data = cache.get(key)
+            if data is not None:
+                return data, {}
+        if deadline.expired():
+            raise deadline.DeadlineExceededError(
+                "no result of another process before the deadline")
+
+    try:
+        data, errors = compute()
+        if not errors:
+            cache.set(key, data, ttl)
+    finally:
+        if owner:
+            cache.delete(lock_key)
+
+    return data, errors
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from excalibur.utils import ALL_KEYWORD, SOURCE_SEPARATOR
+
+"""
+Coalescing of the identical queries which run at the same time
+
+With EXCALIBUR_COALESCE, a query waits for the run of an identical query
+already running in the process and gets a copy of its data and errors.
+The checks (signature, acl, arguments) are always done for each query, only
+the plugins run is shared.
+
+"""
+
+
+def flight_key(query):
+    """
+    the key of the identical queries. The sources of "all" depend on the
+    signature, which is then part of the key.
+    """
+    key = [query.project, query.source, query.ressource, query.method,
+           query.request_method, query.arguments]
+    if query.source == ALL_KEYWORD or SOURCE_SEPARATOR in query.source:
+        key.append(query.signature)
+    return json.dumps(key, sort_keys=True, default=str)
+
+
+class Flight(object):
+
+    """ a running call and its result """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    """
+    run a function once for all the callers of a key at the same time
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def run(self, key, func, timeout=None):
+        """
+        return the result of func and if it was run by another caller.
+        A caller which waits more than timeout seconds calls func alone.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                return func(), False
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+            return flight.result, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
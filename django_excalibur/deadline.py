@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+
+"""
+Time budget of the excalibur requests
+
+The plugins of a request must answer within EXCALIBUR_DEADLINE seconds, or
+the "deadline" of the ressource method::
+
+    members:
+        method2:
+            request method: GET
+            deadline: 2.5
+
+Once the deadline is over, the plugins not called yet are skipped with a
+DeadlineExceededError. The deadline of the running plugin is kept by
+thread, the SPORE clients never wait longer than it.
+
+"""
+
+local = threading.local()
+
+
+class DeadlineExceededError(Exception):
+
+    """
+    the time budget of the request is over
+    """
+
+
+def get_budget(ressources, ressource, method):
+    """ the time budget of a ressource method in seconds, None if none """
+    try:
+        budget = ressources[ressource][method].get('deadline')
+    except (KeyError, TypeError, AttributeError):
+        budget = None
+    return budget or getattr(settings, 'EXCALIBUR_DEADLINE', None)
+
+
+@contextmanager
+def use_deadline(deadline):
+    """ set the deadline of the thread in the block """
+    previous = getattr(local, 'deadline', None)
+    local.deadline = deadline
+    try:
+        yield
+    finally:
+        local.deadline = previous
+
+
+def remaining(deadline=None):
+    """
+    the seconds left before the deadline, or the one of the thread, None
+    without deadline
+    """
+    deadline = deadline or getattr(local, 'deadline', None)
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
+
+
+def expired(deadline=None):
+    """ check if the deadline, or the one of the thread, is over """
+    return remaining(deadline) == 0
+
+
+def timeout(default=None):
+    """ a timeout which never ends after the deadline of the thread """
+    left = remaining()
+    if left is None:
+        return default
+    return left if default is None else min(default, left)
@@ -1,47 +1,69 @@
 # -*- coding: utf-8 -*-
+import collections
+import threading
 from functools import wraps
+from django.conf import settings
+from . import metrics
 
 """
 decorators for excalibur
 """
 
+# responses left to the referentiel, by reason
+skipped = collections.Counter()
+skipped_lock = threading.Lock()
+
+
+def count_skipped(reason):
+    """ count a response left to the referentiel """
+    with skipped_lock:
+        skipped[reason] += 1
+    metrics.increment('excalibur.skipped', reason=reason)
+
+
+def request_args(request):
+    """
+    the arguments of the request, GET without REQUEST (Django 1.9+)
+    """
+    args = getattr(request, 'REQUEST', None)
+    return args if args is not None else request.GET
+
+
+def skip_reason(request, response):
+    """
+    return why the request does not need excalibur, None if it does.
+    The cheapest checks come first, most responses stop at the status code
+    or the content type.
+    """
+    # Run excalibur if the response from the referentiel is 200 (data ok)
+    # or 404 (not found, but excalibur try to find it), never on 401 or 403
+    if response.status_code not in (200, 404):
+        return 'status code'
+    if response.get('Content-Type') != 'application/json':
+        return 'content type'
+    if request.method != "GET":
+        return 'method'
+    prefixes = getattr(settings, 'EXCALIBUR_SKIP_PATH_PREFIXES', None)
+    if prefixes and request.path.startswith(tuple(prefixes)):
+        return 'path'
+    if "REQUEST_EXCALIBUR_PARAMS" not in request.META:
+        return 'params'
+    args = request_args(request)
+    if 'project' not in args or 'establishment' not in args:
+        return 'args'
+    return None
+
 
 def is_excalibur(func):
     """
     check if excalibur can be called
     """
 
-    def check_content_type(response):
-        """ check if the content type of the response is json """
-        return response['Content-Type'] == 'application/json'
-
-    def check_request(request):
-        """ check the request method and args """
-        return request.method == "GET" and 'project' in \
-            request.REQUEST.keys() and 'establishment' in request.REQUEST.keys() \
-            and "REQUEST_EXCALIBUR_PARAMS" in request.META
-
-    def check_permission(request, response):
-        """ check if not 401 or 403 """
-        return response.status_code not in (401, 403)
-
-    def check_status_code(response):
-        """
-        Run excalibur if the response from the referentiel is 200 (data ok) or
-        404 (not found, but excalibur try to find it)
-        """
-        return response.status_code in (200, 404)
-
-    def check_excalibur(request, response):
-        """
-        return true if the request needs excalibur
-        """
-        return check_content_type(response) and check_request(request)\
-            and check_permission(request, response) and check_status_code(response)
-
     @wraps(func)
     def wrapper(middleware, request, response):
-        if not check_excalibur(request, response):
+        reason = skip_reason(request, response)
+        if reason:
+            count_skipped(reason)
             return response
         return func(middleware, request, response)
 
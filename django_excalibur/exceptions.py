@@ -4,13 +4,19 @@ import json
 Excalibur exceptions handler
 """
 
+# the structured errors of the plugins in a response
+ERRORS_KEY = '_excalibur_errors'
 
-def excalibur_exception_handler(exc, response):
+
+def excalibur_exception_handler(exc, response, errors=None):
     """
-    Return excalibur error response
+    Return excalibur error response, with the plugins errors if any
     """
+    content = {'error': str(exc)}
+    if errors:
+        content[ERRORS_KEY] = errors
 
-    response.content = json.dumps({'error': str(exc)})
+    response.content = json.dumps(content)
     response.status_code = 500
 
     return response
\ No newline at end of file
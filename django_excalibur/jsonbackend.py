@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import importlib
+import json
+import logging
+from django.conf import settings
+from . import metrics
+
+"""
+JSON backend of the excalibur middleware
+
+EXCALIBUR_JSON_BACKEND chooses the module used to decode the referentiel
+responses and encode the aggregated ones: "json" (default), "ujson",
+"orjson", or "auto" for the fastest installed one.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+backend = None
+
+
+def get_backend():
+    """ import the configured json module once """
+    global backend
+    if backend is None:
+        name = getattr(settings, 'EXCALIBUR_JSON_BACKEND', 'json')
+        for module_name in BACKENDS if name == 'auto' else (name,):
+            try:
+                backend = importlib.import_module(module_name)
+                break
+            except ImportError:
+                logger.warning("json backend %s not installed" % module_name)
+        else:
+            backend = json
+    return backend
+
+
+def loads(content):
+    """ decode json bytes or text """
+    module = get_backend()
+    with metrics.timer('excalibur.json.decode'):
+        if module is json and isinstance(content, bytes):
+            content = str(content, 'utf-8')
+        return module.loads(content)
+
+
+def dumps(data):
+    """
+    encode data to json, as bytes or text depending on the backend. The
+    data a fast backend cannot encode (big ints) are encoded by json.
+    """
+    module = get_backend()
+    with metrics.timer('excalibur.json.encode'):
+        if module is json:
+            return json.dumps(data)
+        try:
+            if module.__name__ == 'orjson':
+                # the int keys are encoded like json does
+                return module.dumps(data, option=module.OPT_NON_STR_KEYS)
+            return module.dumps(data)
+        except (TypeError, OverflowError, ValueError):
+            return json.dumps(data)
+
+
+def is_json_list(content):
+    """ check if json bytes are a list, without decoding them """
+    return content[:64].lstrip()[:1] == b'['
+
+
+def iter_json_list(content, items, chunk_size=65536):
+    """
+    stream the json list content followed by the items, the content is
+    never decoded and the items are encoded one by one
+    """
+    end = content.rindex(b']')
+    last = end - 1
+    while last >= 0 and content[last:last + 1].isspace():
+        last -= 1
+    empty = content[last:last + 1] == b'['
+
+    view = memoryview(content)
+    for start in range(0, end, chunk_size):
+        yield bytes(view[start:min(start + chunk_size, end)])
+
+    encoder = json.JSONEncoder()
+    chunks, size = [], 0
+    for item in items:
+        if not empty:
+            chunks.append(',')
+        empty = False
+        for chunk in encoder.iterencode(item):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield ''.join(chunks).encode('utf-8')
+                chunks, size = [], 0
+    chunks.append(']')
+    yield ''.join(chunks).encode('utf-8')
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django_excalibur.models import ExcaliburConf, load_configurations,\
+    warm_up
+from django_excalibur.schema import validate
+
+"""
+Check the excalibur configuration and build its plugins runner::
+
+    python manage.py excalibur_warm_up
+
+"""
+
+
+class Command(BaseCommand):
+
+    help = "validate the excalibur configuration and build the runner"
+
+    def handle(self, *args, **options):
+        names = (settings.EXCALIBUR_ACL, settings.EXCALIBUR_SOURCES,
+                 settings.EXCALIBUR_RESSOURCES)
+        try:
+            for conf in load_configurations(*names):
+                validate(conf.name, conf.content())
+            ExcaliburConf.removeInstance()
+            conf = warm_up()
+        except Exception as e:
+            raise CommandError("excalibur configuration: %s" % e)
+        self.stdout.write("excalibur configuration %s is ready" %
+                          conf.version)
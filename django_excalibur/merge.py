@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import copy
+from django.conf import settings
+from excalibur.exceptions import ConfigurationLoaderError
+from excalibur.utils import set_plugin_name
+
+"""
+Merge of the plugins data in the referentiel dict
+
+The strategy is EXCALIBUR_MERGE_STRATEGY ("referentiel first" by default)
+or the "merge" entry of the ressource method::
+
+    members:
+        method2:
+            request method: GET
+            merge:
+                strategy: plugin first
+                precedence:
+                    mail: [Ldapuds, referentiel]
+
+"""
+
+REFERENTIEL = 'referentiel'
+
+
+def referentiel_first(data, values, plugin_keys):
+    """ keep the existing keys, the first plugin wins """
+    for key, value in values.items():
+        if key not in data:
+            data[key] = value
+
+
+def plugin_first(data, values, plugin_keys):
+    """ the plugins replace the referentiel keys, the first plugin wins """
+    for key, value in values.items():
+        if key not in plugin_keys:
+            data[key] = value
+            plugin_keys.add(key)
+
+
+def deep(data, values, plugin_keys):
+    """ like referentiel first, but the nested dicts are merged too """
+    for key, value in values.items():
+        if key not in data:
+            # the plugin dicts can be shared, never merge into them
+            data[key] = copy.deepcopy(value) if isinstance(value, dict) \
+                else value
+        elif isinstance(data[key], dict) and isinstance(value, dict):
+            deep(data[key], value, plugin_keys)
+
+
+STRATEGIES = {
+    'referentiel first': referentiel_first,
+    'plugin first': plugin_first,
+    'deep': deep,
+}
+
+
+def get_merge_options(ressources, ressource, method):
+    """ get the merge entry of a ressource method """
+    try:
+        return ressources[ressource][method].get('merge') or {}
+    except (KeyError, TypeError, AttributeError):
+        return {}
+
+
+def merge_dict(data, newdata, strategy=None, precedence=None):
+    """
+    merge the plugins data in the referentiel dict.
+    A dict from a plugin is merged with the strategy, anything else is set
+    under the plugin name. The precedence gives, by key, the ordered
+    sources of the value.
+    """
+    strategy = strategy or getattr(settings, 'EXCALIBUR_MERGE_STRATEGY',
+                                   'referentiel first')
+    try:
+        merge = STRATEGIES[strategy]
+    except KeyError:
+        raise ConfigurationLoaderError("unknown merge strategy %s" % strategy)
+
+    referentiel = {key: data[key] for key in precedence or {} if key in data}
+    plugin_keys = set()
+
+    for name, values in newdata.items():
+        if isinstance(values, dict):
+            merge(data, values, plugin_keys)
+        # if its a list or other, just add a new key named like the plugin
+        else:
+            data[name] = values
+
+    for key, sources in (precedence or {}).items():
+        for source in sources:
+            if source == REFERENTIEL:
+                if key in referentiel:
+                    data[key] = referentiel[key]
+                    break
+                continue
+            values = [v for n, v in newdata.items()
+                      if set_plugin_name(n) == source and
+                      isinstance(v, dict) and key in v]
+            if values:
+                data[key] = values[0][key]
+                break
+
+    return data
+
+
+def merge_list(data, newdata):
+    """
+    merge the plugins data in the referentiel list
+    """
+    for values in newdata.values():
+        # if the plugin return a list, merge the two lists
+        if isinstance(values, list):
+            data += values
+        # if the plugin return something else, just append
+        else:
+            data.append(values)
+
+    return data
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import importlib
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.http import HttpResponse
+
+"""
+Metrics of the excalibur middleware
+
+The metrics are sent to the sinks of EXCALIBUR_METRICS_SINKS, dotted paths
+of sink classes or (dotted path, options) pairs, without sink nothing is
+measured::
+
+    EXCALIBUR_METRICS_SINKS = [
+        'django_excalibur.metrics.LoggingSink',
+        ('django_excalibur.metrics.StatsdSink', {'port': 8125}),
+        'django_excalibur.metrics.PrometheusSink',
+    ]
+
+The metrics of the PrometheusSink are served by prometheus_view.
+
+    excalibur.request        timing  ressource, method
+    excalibur.errors         count   error
+    excalibur.skipped        count   reason
+    excalibur.plugin         timing  plugin, method
+    excalibur.plugin.errors  count   plugin, error
+    excalibur.plugin.cache   count   plugin, result (hit or miss)
+    excalibur.plugin.skipped count   plugin
+    excalibur.query.coalesced count  ressource, method
+    excalibur.runner.build   timing
+    excalibur.json.decode    timing
+    excalibur.json.encode    timing
+    excalibur.payload        size    ressource, method
+
+"""
+
+logger = logging.getLogger(__name__)
+
+TIMING = 'timing'
+COUNT = 'count'
+SIZE = 'size'
+
+sinks = None
+
+
+class Sink(object):
+
+    """
+    a metrics sink, records the timings (seconds), counts and sizes (bytes)
+    """
+
+    def record(self, kind, name, value, tags):
+        raise NotImplementedError
+
+
+class LoggingSink(Sink):
+
+    """ log each metric """
+
+    def __init__(self, logger_name=__name__, level=logging.INFO):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+
+    def record(self, kind, name, value, tags):
+        self.logger.log(self.level, "%s %s %s %s" % (
+            kind, name, value,
+            " ".join("%s=%s" % item for item in sorted(tags.items()))))
+
+
+class StatsdSink(Sink):
+
+    """
+    send each metric to a StatsD server over UDP, the tags values are
+    appended to the name
+    """
+
+    TYPES = {TIMING: 'ms', COUNT: 'c', SIZE: 'h'}
+
+    def __init__(self, host='localhost', port=8125, prefix=''):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, kind, name, value, tags):
+        name = ".".join([self.prefix + name] + [
+            str(tags[key]).replace('.', '_') for key in sorted(tags)])
+        if kind == TIMING:
+            value = value * 1000
+        line = "%s:%s|%s" % (name.replace(':', '_').replace('|', '_'),
+                             value, self.TYPES[kind])
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error as e:
+            logger.debug("statsd: %s" % e)
+
+
+class PrometheusSink(Sink):
+
+    """
+    keep the counters and histograms in the process, for the prometheus
+    text format
+    """
+
+    BUCKETS = {
+        TIMING: (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+        SIZE: (1e3, 1e4, 1e5, 1e6, 1e7),
+    }
+    SUFFIXES = {TIMING: '_seconds', COUNT: '_total', SIZE: '_bytes'}
+
+    def __init__(self, buckets=None):
+        self.buckets = dict(self.BUCKETS, **(buckets or {}))
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, value, tags):
+        key = (name.replace('.', '_') + self.SUFFIXES[kind], kind,
+               tuple(sorted((k, str(v)) for k, v in tags.items())))
+        with self.lock:
+            if kind == COUNT:
+                self.metrics[key] = self.metrics.get(key, 0) + value
+                return
+            # cumulative buckets, sum and count
+            metric = self.metrics.setdefault(
+                key, [[0] * len(self.buckets[kind]), 0, 0])
+            for index, bound in enumerate(self.buckets[kind]):
+                if value <= bound:
+                    metric[0][index] += 1
+            metric[1] += value
+            metric[2] += 1
+
+    @staticmethod
+    def labels(tags, *extra):
+        tags = tags + extra
+        if not tags:
+            return ''
+        return '{%s}' % ",".join('%s="%s"' % (key, value.replace(
+            '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in tags)
+
+    def render(self):
+        """ the metrics in the prometheus text format """
+        lines, types = [], set()
+        with self.lock:
+            metrics = sorted((key, value if key[1] == COUNT
+                              else [list(value[0]), value[1], value[2]])
+                             for key, value in self.metrics.items())
+        for (name, kind, tags), value in metrics:
+            if name not in types:
+                types.add(name)
+                lines.append("# TYPE %s %s" % (
+                    name, 'counter' if kind == COUNT else 'histogram'))
+            if kind == COUNT:
+                lines.append("%s%s %s" % (name, self.labels(tags), value))
+                continue
+            buckets, total, count = value
+            for bound, bucket in zip(self.buckets[kind], buckets):
+                lines.append("%s_bucket%s %s" % (
+                    name, self.labels(tags, ('le', '%g' % bound)), bucket))
+            lines.append("%s_bucket%s %s" % (
+                name, self.labels(tags, ('le', '+Inf')), count))
+            lines.append("%s_sum%s %s" % (name, self.labels(tags), total))
+            lines.append("%s_count%s %s" % (name, self.labels(tags), count))
+        return "\n".join(lines) + "\n"
+
+
+class MemorySink(Sink):
+
+    """ keep the metrics in a list, for the tests """
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, kind, name, value, tags):
+        self.records.append((kind, name, value, tags))
+
+    def values(self, name, **tags):
+        """ the values of a metric with these tags """
+        return [value for kind, record_name, value, record_tags
+                in self.records if record_name == name and
+                all(record_tags.get(k) == v for k, v in tags.items())]
+
+
+def load_sink(sink):
+    """ build a sink from its dotted path, or (dotted path, options) """
+    path, options = (sink, {}) if isinstance(sink, str) else sink
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name),
+                   class_name)(**options)
+
+
+def get_sinks():
+    """ the configured sinks, built once """
+    global sinks
+    if sinks is None:
+        sinks = [load_sink(sink) for sink in getattr(
+            settings, 'EXCALIBUR_METRICS_SINKS', [])]
+    return sinks
+
+
+def set_sinks(new_sinks):
+    """ replace the sinks, None to build them again from the settings """
+    global sinks
+    sinks = list(new_sinks) if new_sinks is not None else None
+
+
+def record(kind, name, value, **tags):
+    """ send a metric to the sinks, a failing sink never fails a request """
+    for sink in get_sinks():
+        try:
+            sink.record(kind, name, value, tags)
+        except Exception as e:
+            logger.warning("metrics sink %s: %s" % (
+                sink.__class__.__name__, e))
+
+
+def timing(name, seconds, **tags):
+    record(TIMING, name, seconds, **tags)
+
+
+def increment(name, value=1, **tags):
+    record(COUNT, name, value, **tags)
+
+
+def size(name, value, **tags):
+    record(SIZE, name, value, **tags)
+
+
+@contextmanager
+def timer(name, **tags):
+    """ time the block, only if there is a sink """
+    if not get_sinks():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, time.perf_counter() - start, **tags)
+
+
+def prometheus_view(request):
+    """ the metrics of the prometheus sinks """
+    return HttpResponse(
+        "".join(sink.render() for sink in get_sinks()
+                if isinstance(sink, PrometheusSink)),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
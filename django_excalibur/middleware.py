@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
-from excalibur.core import PluginsRunner
-from excalibur.exceptions import ConfigurationLoaderError, ExcaliburError
+from excalibur.exceptions import ConfigurationLoaderError, ExcaliburError,\
+    NoACLMatchedError
 import logging
+import time
+from . import metrics
+from .acl import get_targets
+from .deadline import get_budget
 from .decorators import is_excalibur
+from .merge import get_merge_options
 from .models import ExcaliburConf
-from .utils import ExcaliburAttack
+from .utils import ExcaliburAttack, only_optional
 from .exceptions import excalibur_exception_handler
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -21,36 +26,104 @@ class ExcaliburMiddleware(object):
             use excalibur when optional "project" and "source" params
             are in the url
         """
+        start = time.perf_counter()
+        # get all params for query
+        excalibur = ExcaliburAttack(request, response)
         try:
-            # get all params for query
-            excalibur = ExcaliburAttack(request, response)
-            # get user
-            user = excalibur.get_request_user()
+            prepared = self.prepare(excalibur, start)
 
-            if user:
-                try:
-                    excconf = ExcaliburConf()
-                except (AttributeError, ObjectDoesNotExist) as e:
-                    raise ConfigurationLoaderError(str(e))
-
-                # run plugins
-                plugin_runner = PluginsRunner(
-                    excconf.acl_conf.configuration,
-                    excconf.sources_conf.configuration,
-                    excconf.ressource_conf.configuration,
-                    excconf.plugins_module,
-                    raw_yaml_content=True,
-                    check_signature=False if user.is_superuser else True
-                )
-
-                newdata, errors = excalibur.make_and_run_query(plugin_runner)
-                if not errors:
-                    response = excalibur.aggregate_data(newdata)
+            if prepared:
+                plugin_runner, merge = prepared
+                if excalibur.ids:
+                    # batch: one query by id, errors by id
+                    results = excalibur.make_and_run_batch(plugin_runner)
                 else:
-                    response = excalibur.manage_errors(errors)
+                    results = excalibur.make_and_run_query(plugin_runner)
+                response = self.aggregate(excalibur, merge, results)
 
         except ExcaliburError as e:
-            logger.error(e.message)
-            response = excalibur_exception_handler(e, response)
+            response = self.handle_error(e, response)
+
+        return self.finish(excalibur, response, start)
+
+    def prepare(self, excalibur, start):
+        """
+        get the plugins runner and the merge options of the request, None
+        without user
+        """
+        timings = excalibur.timings
+        # get user
+        with timings.measure('token'):
+            user = excalibur.get_request_user()
+
+        if not user:
+            return None
+
+        try:
+            with timings.measure('conf'):
+                excconf = ExcaliburConf()
+        except (AttributeError, ObjectDoesNotExist) as e:
+            raise ConfigurationLoaderError(str(e))
+
+        with timings.measure('runner'):
+            plugin_runner = excconf.get_plugin_runner(
+                check_signature=False if user.is_superuser else True)
+
+        # reject the denied methods before any query
+        targets = get_targets(plugin_runner, excalibur.project,
+                              excalibur.source)
+        if targets is not None and not excconf.acl_index.is_allowed(
+                excalibur.project, targets, excalibur.ressource,
+                excalibur.method):
+            raise NoACLMatchedError("%s/%s" % (excalibur.ressource,
+                                               excalibur.method))
+
+        merge = get_merge_options(plugin_runner.ressources,
+                                  excalibur.ressource,
+                                  excalibur.method)
+
+        # time budget of the plugins, from the start of excalibur
+        budget = get_budget(plugin_runner.ressources,
+                            excalibur.ressource, excalibur.method)
+        if budget:
+            excalibur.deadline = time.time() + budget - (
+                time.perf_counter() - start)
+
+        return plugin_runner, merge
+
+    def aggregate(self, excalibur, merge, results):
+        """
+        aggregate the plugins results, the data and errors of the query or
+        of each id of a batch
+        """
+        with excalibur.timings.measure('aggregate'):
+            if excalibur.ids:
+                return excalibur.aggregate_batch(results, merge)
+
+            newdata, errors = results
+            # the optional plugins can fail
+            if not errors or only_optional(errors):
+                return excalibur.aggregate_data(newdata, merge, errors)
+            return excalibur.manage_errors(errors)
+
+    def handle_error(self, e, response):
+        """ the error response of an excalibur error """
+        logger.error(e.message)
+        metrics.increment('excalibur.errors', error=e.__class__.__name__)
+        return excalibur_exception_handler(e, response)
+
+    def finish(self, excalibur, response, start):
+        """ add the excalibur headers and measures to the response """
+        if excalibur.partial:
+            response['X-Excalibur-Partial'] = ", ".join(
+                sorted(set(excalibur.partial)))
+
+        elapsed = time.perf_counter() - start
+        metrics.timing('excalibur.request', elapsed,
+                       ressource=excalibur.ressource, method=excalibur.method)
+        timings = excalibur.timings
+        if timings.enabled:
+            timings.add('excalibur', elapsed)
+            response['Server-Timing'] = timings.header()
 
         return response
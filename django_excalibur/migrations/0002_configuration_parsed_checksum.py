@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_excalibur', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='parsed',
+            field=models.TextField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='configuration',
+            name='checksum',
+            field=models.CharField(max_length=40, null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,60 +1,275 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+import hashlib
+import json
+import threading
+import time
+import uuid
 import yaml
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from rest_framework.authtoken.models import Token
+from . import metrics
+from .acl import AclIndex
+from .cache import get_cache
+from .runners import ExcaliburPluginsRunner
+from .schema import validate
+from .tokens import forget_token, forget_user
+
+
+# key of the configuration generation shared by all the processes: the
+# version of the configuration in database
+GENERATION_CACHE_KEY = 'django_excalibur:configuration:generation'
+
+
+def get_generation():
+    """ get the current configuration generation """
+    return get_cache().get(GENERATION_CACHE_KEY)
+
+
+def new_generation():
+    """
+    publish the version of the configuration in database, each process
+    reloads its configuration until it has this version. A process which
+    loads before the transaction of the change is committed gets the old
+    version, and loads again at its next check.
+    """
+    try:
+        version = configuration_version(load_configurations(
+            settings.EXCALIBUR_ACL, settings.EXCALIBUR_SOURCES,
+            settings.EXCALIBUR_RESSOURCES))
+    except Configuration.DoesNotExist:
+        # an incomplete configuration, which no process can have
+        version = uuid.uuid4().hex
+    get_cache().set(GENERATION_CACHE_KEY, version, None)
+
+
+def configuration_version(configurations):
+    """ hash of the configurations used by the plugins runner """
+    to_hash = settings.EXCALIBUR_PLUGINS_MODULE
+    for conf in configurations:
+        to_hash += conf.name + (conf.configuration or '')
+    return hashlib.sha1(to_hash.encode('utf-8')).hexdigest()
+
+
+def checksum(text):
+    """ hash of a configuration text """
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
 
 
 class Configuration(models.Model):
     """
-    yaml configuration in database
+    yaml configuration in database, with its content parsed as json when
+    json can keep it as it is
     """
     name = models.CharField(max_length=53, unique=True)
     configuration = models.TextField(blank=True, null=True)
+    parsed = models.TextField(blank=True, null=True, editable=False)
+    checksum = models.CharField(max_length=40, blank=True, null=True,
+                                editable=False)
 
     def save(self, *args, **kwargs):
         try:
-            yaml.load(self.configuration)
+            content = yaml.load(self.configuration)
+            validate(self.name, content)
         except Exception as e:
             raise ValidationError(e)
         else:
+            # keys or values which json changes or cannot encode (dates),
+            # parse the yaml again
+            try:
+                parsed = json.dumps(content)
+            except (TypeError, ValueError):
+                parsed = None
+            self.parsed = parsed if parsed is not None and \
+                json.loads(parsed) == content else None
+            self.checksum = checksum(self.configuration)
             super(Configuration, self).save(*args, **kwargs)
             # reinitialize the excalbur conf singleton
-            ExcaliburConf.removeInstance()
+            ExcaliburConf.invalidate()
+
+    def delete(self, *args, **kwargs):
+        super(Configuration, self).delete(*args, **kwargs)
+        ExcaliburConf.invalidate()
+
+    def content(self):
+        """
+        the parsed configuration, from the json if it is the one of the
+        configuration text
+        """
+        if self.parsed is not None and \
+                self.checksum == checksum(self.configuration):
+            return json.loads(self.parsed) or {}
+        return yaml.load(self.configuration or '') or {}
 
     class Meta:
         db_table = 'excalibur_configuration'
 
 
+def load_configurations(*names):
+    """ the configurations of these names, with a single query """
+    configurations = dict(
+        (conf.name, conf)
+        for conf in Configuration.objects.filter(name__in=names))
+    for name in names:
+        if name not in configurations:
+            raise Configuration.DoesNotExist(
+                "no configuration named %s" % name)
+    return [configurations[name] for name in names]
+
+
+# compiled plugins runners, by (configuration version, check_signature)
+plugin_runners = {}
+runners_lock = threading.Lock()
+
+
 class ExcaliburConf():
 
     """
-    load the configuration from database
+    load the configuration from database, once for all the threads. The
+    loaded configuration is never changed, a reload replaces it.
     """
 
     instance = None
+    lock = threading.Lock()
 
     class __ExcaliburConf:
 
-        def __init__(self):
-            self.sources_conf = Configuration.objects.get(
-                name=settings.EXCALIBUR_SOURCES)
-            self.ressource_conf = Configuration.objects.get(
-                name=settings.EXCALIBUR_RESSOURCES)
-            self.acl_conf = Configuration.objects.get(
-                name=settings.EXCALIBUR_ACL)
+        # the only attribute which changes once loaded
+        MUTABLE = ('checked_at',)
+
+        def __init__(self, previous=None):
+            # the generation which triggers the load, read first: a change
+            # during the load is seen at the next check
+            self.generation = get_generation()
+            self.checked_at = time.time()
+            self.sources_conf, self.ressource_conf, self.acl_conf = \
+                load_configurations(settings.EXCALIBUR_SOURCES,
+                                    settings.EXCALIBUR_RESSOURCES,
+                                    settings.EXCALIBUR_ACL)
             self.plugins_module = settings.EXCALIBUR_PLUGINS_MODULE
+            self.version = configuration_version(
+                (self.acl_conf, self.sources_conf, self.ressource_conf))
+            self.acl = self.acl_conf.content()
+            self.sources = self.sources_conf.content()
+            self.ressources = self.ressource_conf.content()
+            self.acl_index = AclIndex(self.acl)
+            # loaded again for the same generation without a change: the
+            # generation of a rolled back save, which is never reached
+            self.settled = previous is not None and \
+                previous.generation == self.generation and \
+                previous.version == self.version
+            self.frozen = True
+
+        def __setattr__(self, name, value):
+            if getattr(self, 'frozen', False) and name not in self.MUTABLE:
+                raise AttributeError(
+                    "the excalibur configuration is read only")
+            self.__dict__[name] = value
+
+        def is_outdated(self):
+            """
+            check if another process has changed the configuration, at most
+            every EXCALIBUR_CONF_CHECK_INTERVAL seconds
+            """
+            now = time.time()
+            if now - self.checked_at < getattr(
+                    settings, 'EXCALIBUR_CONF_CHECK_INTERVAL', 5):
+                return False
+            self.checked_at = now
+            generation = get_generation()
+            if generation is None or generation == self.version:
+                return False
+            return not (self.settled and generation == self.generation)
+
+        def get_plugin_runner(self, check_signature=True):
+            """
+            return the plugins runner for this configuration version,
+            build it only once
+            """
+            key = (self.version, check_signature)
+            runner = plugin_runners.get(key)
+            if runner is not None:
+                return runner
+            with runners_lock:
+                # built by another thread while waiting
+                runner = plugin_runners.get(key)
+                if runner is not None:
+                    return runner
+                with metrics.timer('excalibur.runner.build'):
+                    runner = ExcaliburPluginsRunner(
+                        self.acl,
+                        self.sources,
+                        self.ressources,
+                        self.plugins_module,
+                        raw_yaml_content=True,
+                        check_signature=check_signature,
+                        max_workers=getattr(
+                            settings, 'EXCALIBUR_MAX_WORKERS', 1),
+                        plugin_timeout=getattr(
+                            settings, 'EXCALIBUR_PLUGIN_TIMEOUT', None),
+                        coalesce=getattr(
+                            settings, 'EXCALIBUR_COALESCE', False)
+                    )
+                # forget the runners of the old configurations, a thread
+                # may still use one: its executor is not shut down, its
+                # workers stop once it is garbage collected
+                for old_key in [k for k in plugin_runners
+                                if k[0] != self.version]:
+                    plugin_runners.pop(old_key, None)
+                plugin_runners[key] = runner
+            return runner
 
     def __new__(cls):
-        if not ExcaliburConf.instance:
-            ExcaliburConf.instance = ExcaliburConf.__ExcaliburConf()
-        return ExcaliburConf.instance
+        instance = ExcaliburConf.instance
+        if instance and not instance.is_outdated():
+            return instance
+        with ExcaliburConf.lock:
+            # only one thread loads, the others get its configuration
+            if ExcaliburConf.instance is not instance and \
+                    ExcaliburConf.instance:
+                return ExcaliburConf.instance
+            ExcaliburConf.instance = ExcaliburConf.__ExcaliburConf(instance)
+            return ExcaliburConf.instance
 
     def __getattr__(self, name):
         return getattr(self.instance, name)
 
-    def __setattr__(self, name):
-        return setattr(self.instance, name)
+    def __setattr__(self, name, value):
+        return setattr(self.instance, name, value)
 
     @staticmethod
     def removeInstance():
-        ExcaliburConf.instance = None
\ No newline at end of file
+        ExcaliburConf.instance = None
+
+    @staticmethod
+    def invalidate():
+        """ reload the configuration in all the processes """
+        new_generation()
+        ExcaliburConf.removeInstance()
+
+
+def warm_up():
+    """
+    load the configuration and build the plugins runner before the first
+    request, at the start of a worker (the post_fork hook of gunicorn),
+    or with the excalibur_warm_up command
+    """
+    conf = ExcaliburConf()
+    conf.get_plugin_runner()
+    return conf
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def forget_token_user(sender, instance, **kwargs):
+    """ a changed or deleted token is read again from the database """
+    forget_token(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_user_tokens(sender, instance, **kwargs):
+    """ the tokens of a changed or deleted user are read again """
+    forget_user(instance.pk)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+import collections
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from excalibur.conf import Acl, Ressources, Sources
+from excalibur.core import PluginsRunner
+from excalibur.loader import PluginLoader
+from excalibur.utils import data_or_errors, format_error, set_plugin_name,\
+    separator_contained
+from . import metrics
+from .breaker import get_breaker, keep_last_good, last_good
+from .deadline import DeadlineExceededError, expired, remaining,\
+    use_deadline
+from .cache import cached_result, get_ttl, result_key
+from .coalesce import SingleFlight, flight_key
+
+"""
+Plugins runners for the excalibur middleware
+
+"""
+
+
+# configurations given to the runner already parsed
+CONFIGURATION_CLASSES = {'acl': Acl, 'sources': Sources,
+                         'ressources': Ressources}
+
+
+class PluginTimeoutError(Exception):
+
+    """
+    a plugin did not answer in time
+    """
+
+
+def plugin_key(plugin_name):
+    """
+    the key of the plugin in the data returned by the runner
+    """
+    return plugin_name if separator_contained(plugin_name) \
+        else set_plugin_name(plugin_name)
+
+
+def is_optional(parameters_sets):
+    """
+    check if the plugin can fail without failing the query, with
+    "required" or "optional" in its parameters sets or EXCALIBUR_PARTIAL
+    """
+    for parameters in parameters_sets or []:
+        if isinstance(parameters, dict):
+            if parameters.get('required'):
+                return False
+            if parameters.get('optional'):
+                return True
+    return getattr(settings, 'EXCALIBUR_PARTIAL', False)
+
+
+def mark_optional(errors, parameters_sets):
+    """ mark the errors of an optional plugin """
+    if errors and is_optional(parameters_sets):
+        for error in errors.values():
+            error['optional'] = True
+    return errors
+
+
+class ExcaliburPluginsRunner(PluginsRunner):
+
+    """
+    excalibur plugins runner which can call the plugins of a query
+    concurrently, and takes the configurations as yaml or parsed.
+    With max_workers > 1, the plugins are called in a thread pool and each
+    one is waited at most plugin_timeout seconds after its own start, the
+    time spent in the queue of the pool is not counted. plugin_timeout
+    needs max_workers > 1. The data and errors are returned in the plugins
+    order, like the sequential run, but the plugins do not see the data of
+    the others.
+    With coalesce, the identical queries running at the same time share
+    one run of the plugins.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_workers = kwargs.pop('max_workers', 1) or 1
+        self.plugin_timeout = kwargs.pop('plugin_timeout', None)
+        self.flights = SingleFlight() if kwargs.pop('coalesce', False) \
+            else None
+        if self.plugin_timeout is not None and self.max_workers < 2:
+            # a plugin called in the request thread cannot be stopped
+            raise ImproperlyConfigured(
+                "the plugin timeout needs more than one worker")
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers) \
+            if self.max_workers > 1 else None
+        super(ExcaliburPluginsRunner, self).__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        # PluginsRunner names its private attributes after the class name
+        setattr(self, "_PluginsRunner__" + key, self.resolve(value, key))
+
+    def resolve(self, value, key):
+        # a parsed configuration is loaded like the yaml one
+        if isinstance(value, dict) and key in CONFIGURATION_CLASSES:
+            configuration = CONFIGURATION_CLASSES[key]()
+            configuration.__dict__.update(value)
+            return configuration
+        return super(ExcaliburPluginsRunner, self).resolve(value, key)
+
+    def run_plugin(self, loader, name, query, params, data):
+        """
+        run one plugin and return its own data and errors, from the cache
+        if the plugin has a cache ttl
+        """
+        plugin = set_plugin_name(name)
+        query_deadline = getattr(query, 'deadline', None)
+        if query_deadline is not None and expired(query_deadline):
+            return {}, self.plugin_error(
+                name, query, params, DeadlineExceededError(
+                    "no time left for the plugin"))
+
+        breaker = get_breaker(name, query)
+        if breaker is not None and not breaker.allow():
+            return self.skip_plugin(name, query)
+
+        start = time.perf_counter()
+        ttl = get_ttl(params, query.function_name)
+        computed = []
+        with use_deadline(query_deadline):
+            if ttl:
+                def compute():
+                    computed.append(True)
+                    return self.call_plugin(loader, name, query, params,
+                                            data)
+
+                try:
+                    plugin_data, errors = cached_result(
+                        result_key(name, query), ttl, compute)
+                except DeadlineExceededError as e:
+                    # the deadline ended while waiting for another process
+                    return {}, self.plugin_error(name, query, params, e)
+                metrics.increment('excalibur.plugin.cache', plugin=plugin,
+                                  result='miss' if computed else 'hit')
+            else:
+                plugin_data, errors = self.call_plugin(
+                    loader, name, query, params, data)
+
+        elapsed = time.perf_counter() - start
+        metrics.timing('excalibur.plugin', elapsed, plugin=plugin,
+                       method=query.function_name)
+        timings = getattr(query, 'timings', None)
+        if timings is not None:
+            timings.add_plugin(name, elapsed)
+
+        # only a real call tells if the plugin works
+        if breaker is not None and (computed or not ttl):
+            if errors or self.plugin_timeout is not None and \
+                    elapsed > self.plugin_timeout:
+                breaker.failure()
+            else:
+                breaker.success()
+                keep_last_good(result_key(name, query), plugin_data)
+
+        for error in errors.values():
+            metrics.increment('excalibur.plugin.errors', plugin=plugin,
+                              error=error['error'])
+        return plugin_data, mark_optional(errors, params)
+
+    def wait_plugin(self, future, query_deadline, started, name):
+        """
+        the result of a plugin, waited until the query deadline or the
+        plugin timeout after the start of the plugin
+        """
+        while True:
+            limits = [query_deadline] if query_deadline is not None else []
+            if self.plugin_timeout is not None:
+                # not started yet, its timeout is known once it starts
+                limits.append(started[name] + self.plugin_timeout
+                              if name in started
+                              else time.time() + self.plugin_timeout)
+            timeout = max(0, min(limits) - time.time()) if limits else None
+            try:
+                return future.result(timeout=timeout)
+            except TimeoutError:
+                now = time.time()
+                if query_deadline is not None and now >= query_deadline:
+                    raise DeadlineExceededError(
+                        "no answer before the deadline")
+                if name in started and \
+                        now >= started[name] + self.plugin_timeout:
+                    raise PluginTimeoutError(
+                        "no answer after %ss" % self.plugin_timeout)
+
+    def plugin_error(self, name, query, params, exception):
+        """ the errors of a plugin which was not called or did not answer """
+        metrics.increment('excalibur.plugin.errors',
+                          plugin=set_plugin_name(name),
+                          error=exception.__class__.__name__)
+        return mark_optional(
+            {set_plugin_name(name): format_error(query, exception, 0)},
+            params)
+
+    def skip_plugin(self, name, query):
+        """
+        skip a plugin with an open circuit, its last good data if any are
+        used instead
+        """
+        metrics.increment('excalibur.plugin.skipped',
+                          plugin=set_plugin_name(name))
+        partial = getattr(query, 'partial', None)
+        if partial is not None:
+            partial.append(name)
+        return last_good(result_key(name, query)), {}
+
+    def call_plugin(self, loader, name, query, params, data):
+        """
+        call one plugin and return its own data and errors
+        """
+        plugin_data, errors = data_or_errors(
+            loader, name, query, params,
+            collections.OrderedDict(data), collections.OrderedDict())
+        key = plugin_key(name)
+        return {key: plugin_data[key]} if key in plugin_data else {}, errors
+
+    def run(self, query):
+        """
+        run the plugins of the query, or wait for the run of an identical
+        query
+        """
+        if self.flights is None:
+            return self.run_plugins(query)
+
+        def run_plugins():
+            data, errors = self.run_plugins(query)
+            return data, errors, list(getattr(query, 'partial', None) or [])
+
+        (data, errors, partial), shared = self.flights.run(
+            flight_key(query), run_plugins,
+            remaining(getattr(query, 'deadline', None)))
+        if not shared:
+            return data, errors
+
+        metrics.increment('excalibur.query.coalesced',
+                          ressource=query.ressource, method=query.method)
+        query_partial = getattr(query, 'partial', None)
+        if query_partial is not None:
+            query_partial.extend(partial)
+        # the data and errors of each query can be changed by the middleware
+        return copy.deepcopy(data), copy.deepcopy(errors)
+
+    def run_plugins(self, query):
+        """
+        run the plugins of the query, concurrently if possible
+        """
+        data, errors = collections.OrderedDict(), collections.OrderedDict()
+        loader = PluginLoader(self.plugins_module)
+        plugins = self.plugins(*query("plugins"))
+
+        if self.executor is None or \
+                len(plugins) < 2 and self.plugin_timeout is None:
+            # the plugins get the data of the previous ones
+            for name, params in plugins.items():
+                plugin_data, plugin_errors = self.run_plugin(
+                    loader, name, query, params, data)
+                data.update(plugin_data)
+                errors.update(plugin_errors)
+            return data, errors
+
+        # the plugins are waited until the deadline, or the plugin timeout
+        # after their start
+        query_deadline = getattr(query, 'deadline', None)
+        started = {}
+
+        def run_plugin(name, params):
+            started[name] = time.time()
+            return self.run_plugin(loader, name, query, params, {})
+
+        futures = collections.OrderedDict(
+            (name, self.executor.submit(run_plugin, name, params))
+            for name, params in plugins.items())
+
+        for name, future in futures.items():
+            try:
+                plugin_data, plugin_errors = self.wait_plugin(
+                    future, query_deadline, started, name)
+            except (PluginTimeoutError, DeadlineExceededError) as e:
+                future.cancel()
+                plugin_data = {}
+                plugin_errors = self.plugin_error(name, query, plugins[name],
+                                                  e)
+            data.update(plugin_data)
+            errors.update(plugin_errors)
+
+        return data, errors
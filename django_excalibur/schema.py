@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from excalibur.exceptions import ConfigurationLoaderError
+
+"""
+Structure checks of the configurations, by name (EXCALIBUR_ACL,
+EXCALIBUR_SOURCES and EXCALIBUR_RESSOURCES), before they are saved
+
+"""
+
+
+def check(condition, message, *args):
+    if not condition:
+        raise ConfigurationLoaderError(message % args)
+
+
+def check_methods(methods, path):
+    check(isinstance(methods, list) and
+          all(isinstance(method, str) for method in methods),
+          "acl %s: a list of methods is expected", path)
+
+
+def validate_acl(acl):
+    """ project, source, ressource and methods, or without project """
+    check(isinstance(acl, dict), "the acl must be a mapping")
+    for key, value in acl.items():
+        check(isinstance(value, dict), "acl %s: a mapping is expected", key)
+        for name, entry in value.items():
+            if isinstance(entry, dict):
+                for ressource, methods in entry.items():
+                    check_methods(methods, "%s/%s/%s" % (key, name,
+                                                         ressource))
+            else:
+                check_methods(entry, "%s/%s" % (key, name))
+
+
+def validate_ressources(ressources):
+    """ ressource, method, optional request method and arguments checks """
+    check(isinstance(ressources, dict), "the ressources must be a mapping")
+    for ressource, methods in ressources.items():
+        check(isinstance(methods, dict),
+              "ressource %s: a mapping of methods is expected", ressource)
+        for method, options in methods.items():
+            path = "%s/%s" % (ressource, method)
+            check(isinstance(options, dict),
+                  "ressource %s: a mapping is expected", path)
+            # optional, like in the excalibur request check
+            check(isinstance(options.get('request method', ''), str),
+                  "ressource %s: the request method must be a string", path)
+            arguments = options.get('arguments') or {}
+            check(isinstance(arguments, dict),
+                  "ressource %s: the arguments must be a mapping", path)
+            for name, argument in arguments.items():
+                check(argument is None or isinstance(argument, dict) and
+                      isinstance(argument.get('checks') or {}, dict),
+                      "ressource %s: wrong checks for %s", path, name)
+
+
+def validate_source(source, options):
+    check(isinstance(options, dict) and
+          isinstance(options.get('plugins'), dict),
+          "source %s: the plugins are missing", source)
+    for plugin, parameters_sets in options['plugins'].items():
+        check(isinstance(parameters_sets, list) and
+              all(isinstance(p, dict) for p in parameters_sets),
+              "source %s: %s must be a list of parameters sets",
+              source, plugin)
+    check(isinstance(options.get('plugins_order') or [], list),
+          "source %s: plugins_order must be a list", source)
+
+
+def validate_sources(sources):
+    """ project, sources and plugins, or sources and plugins """
+    check(isinstance(sources, dict), "the sources must be a mapping")
+    for key, value in sources.items():
+        check(isinstance(value, dict), "source %s: a mapping is expected",
+              key)
+        if 'sources' in value:
+            check(isinstance(value['sources'], dict),
+                  "project %s: the sources must be a mapping", key)
+            for source, options in value['sources'].items():
+                validate_source("%s/%s" % (key, source), options)
+        else:
+            validate_source(key, value)
+
+
+def validate(name, content):
+    """
+    check a configuration by its name, an empty configuration or an
+    unknown name are not checked
+    """
+    if content is None:
+        return
+    validator = {
+        getattr(settings, 'EXCALIBUR_ACL', None): validate_acl,
+        getattr(settings, 'EXCALIBUR_SOURCES', None): validate_sources,
+        getattr(settings, 'EXCALIBUR_RESSOURCES', None): validate_ressources,
+    }.get(name)
+    if validator is not None:
+        validator(content)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from britney.core import Spore
+from britney.errors import SporeMethodStatusError
+from britney.middleware import auth, base
+from britney.request import RequestBuilder
+from django.conf import settings
+from . import deadline
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+"""
+Pooled britney clients for the excalibur plugins
+
+The clients are kept by (spore, token) and all send their requests through
+one HTTP adapter, which keeps at most EXCALIBUR_SPORE_MAX_CONNECTIONS_PER_HOST
+connections alive by host. A request never waits for a free connection,
+the extra connections are closed after use. The redirects and the proxies
+of the environment are followed like with britney, the cookies are never
+kept. A client unused for EXCALIBUR_SPORE_CLIENT_IDLE_TIMEOUT seconds is
+dropped.
+
+"""
+
+descriptions = {}
+clients = {}
+lock = threading.Lock()
+adapter = None
+session = None
+
+
+def get_adapter():
+    """ the HTTP adapter shared by all the clients """
+    global adapter
+    if adapter is None:
+        adapter = HTTPAdapter(
+            pool_connections=getattr(
+                settings, 'EXCALIBUR_SPORE_POOL_HOSTS', 10),
+            pool_maxsize=getattr(
+                settings, 'EXCALIBUR_SPORE_MAX_CONNECTIONS_PER_HOST', 10),
+            pool_block=False)
+    return adapter
+
+
+def get_session():
+    """
+    the session of the shared adapter, without cookies: the clients of
+    all the tokens use it
+    """
+    global session
+    if session is None:
+        new_session = Session()
+        new_session.cookies.set_policy(DefaultCookiePolicy(
+            allowed_domains=[]))
+        new_session.mount('http://', get_adapter())
+        new_session.mount('https://', get_adapter())
+        session = new_session
+    return session
+
+
+def get_description(spore):
+    """
+    get the SPORE description, fetched and parsed only once. It is fetched
+    through the shared session, within the SPORE timeout and the deadline.
+    """
+    description = descriptions.get(spore)
+    if description is None:
+        if spore.startswith('http'):
+            if deadline.expired():
+                raise deadline.DeadlineExceededError(
+                    "no time left for %s" % spore)
+            response = get_session().get(spore, timeout=deadline.timeout(
+                getattr(settings, 'EXCALIBUR_SPORE_TIMEOUT', None)))
+            response.raise_for_status()
+            description = response.json()
+        else:
+            with open(spore, 'r') as spore_file:
+                description = json.load(spore_file)
+        descriptions[spore] = description
+    return description
+
+
+class PooledTransport(base.Middleware):
+
+    """
+    britney middleware which sends the request through the shared adapter,
+    it must be the last middleware of the client
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def process_request(self, environ):
+        if deadline.expired():
+            raise deadline.DeadlineExceededError(
+                "no time left for %s" % environ.get('PATH_INFO', ''))
+        request = RequestBuilder(environ)()
+        # never wait after the deadline of the plugin
+        response = get_session().send(
+            request, timeout=deadline.timeout(self.timeout), verify=True)
+        response.environ = environ
+        # same check as britney
+        if not 200 <= response.status_code <= 299 and \
+                response.status_code not in environ['spore.expected_status']:
+            raise SporeMethodStatusError(response)
+        return response
+
+
+def build_client(spore, token):
+    """ build a britney client for the spore with the token """
+    client = Spore(**get_description(spore))
+    client.enable(auth.ApiKey, key_name='Authorization',
+                  key_value='Token %s' % (token,))
+    client.enable(PooledTransport,
+                  timeout=getattr(settings, 'EXCALIBUR_SPORE_TIMEOUT', None))
+    return client
+
+
+def get_client(spore, token):
+    """
+    get the client of (spore, token) from the pool, or build it
+    """
+    now = time.time()
+    idle_timeout = getattr(settings, 'EXCALIBUR_SPORE_CLIENT_IDLE_TIMEOUT',
+                           300)
+    with lock:
+        for key in [k for k, v in clients.items()
+                    if now - v[1] > idle_timeout]:
+            del clients[key]
+        pooled = clients.get((spore, token))
+        client = pooled[0] if pooled else None
+
+    if client is None:
+        client = build_client(spore, token)
+
+    with lock:
+        clients[(spore, token)] = (client, now)
+
+    return client
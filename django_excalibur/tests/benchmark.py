@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+"""
+Benchmarks of the excalibur middleware pipeline
+
+Offline: the plugins are stubs which wait and return data of a given size,
+one of them gets its data from a local fake SPORE server::
+
+    python django_excalibur/tests/benchmark.py --iterations 500 \\
+        --latency 2 --payload 1000 --json results.json
+    python django_excalibur/tests/benchmark.py --baseline results.json \\
+        --threshold 0.2
+
+For each scenario: requests by second, p50 and p99 latency, and the peak
+of the memory allocated by an iteration (tracemalloc). With a baseline, the
+script fails when a scenario is slower than the baseline by more than the
+threshold.
+
+"""
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+
+PLUGINS_MODULE = 'excalibur_benchmark_plugins'
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=False,
+        USE_I18N=False,
+        ROOT_URLCONF='__main__',
+        SECRET_KEY='benchmark',
+        ALLOWED_HOSTS=['*'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=(
+            'django.contrib.auth', 'django.contrib.contenttypes',
+            'rest_framework', 'rest_framework.authtoken',
+            'django_excalibur'),
+        EXCALIBUR_SOURCES="sources.yml",
+        EXCALIBUR_RESSOURCES="ressources.yml",
+        EXCALIBUR_ACL="acl.yml",
+        EXCALIBUR_PLUGINS_MODULE=PLUGINS_MODULE,
+    )
+
+try:
+    from django.conf.urls import url
+except ImportError:
+    from django.urls import re_path as url
+from django.http import HttpResponse
+
+
+def index(request):
+    return HttpResponse("excalibur benchmark")
+
+
+urlpatterns = [
+    url(r'^$', index),
+    url(r'^updates/(?P<memberskey>[^/]+)/(?P<memberscode>[^/.]+)'
+        r'\.(?P<format>[a-z0-9]+)$', index, name='member-updates'),
+]
+
+ACL = """
+bench:
+    etab:
+        members:
+            - method
+"""
+
+RESSOURCES = """
+members:
+    method:
+        request method: GET
+        arguments:
+            id:
+                checks:
+                    min length: 1
+                    max length: 50
+            project:
+                checks:
+                    min length: 1
+                    max length: 50
+            establishment:
+                checks:
+                    min length: 1
+                    max length: 50
+            base_url:
+                checks:
+                    min length: 1
+                    max length: 50
+"""
+
+
+class FakeSporeHandler(BaseHTTPRequestHandler):
+
+    """ answer every GET with a json member after the latency """
+
+    latency = 0
+    payload = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = json.dumps({'path': self.path,
+                           'value': 'x' * self.payload}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSporeServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def start_spore_server(latency, payload, directory):
+    """ start the fake SPORE server, return it and its description file """
+    handler = type('Handler', (FakeSporeHandler,),
+                   {'latency': latency, 'payload': payload})
+    server = FakeSporeServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    description = os.path.join(directory, 'description.json')
+    with open(description, 'w') as f:
+        json.dump({
+            "name": "benchmark",
+            "base_url": "http://127.0.0.1:%s/" % server.server_address[1],
+            "methods": {"get_member": {
+                "method": "GET", "path": "/members/:id",
+                "required_params": ["id"], "authentication": True}}}, f)
+    return server, description
+
+
+def install_plugins(count, latency, payload):
+    """
+    the stub plugins Stub0..StubN and the Remote plugin, in modules which
+    are never written to disk
+    """
+    from django_excalibur.utils import generate_client_and_get_data
+
+    package = types.ModuleType(PLUGINS_MODULE)
+    package.__path__ = []
+    sys.modules[PLUGINS_MODULE] = package
+
+    def stub_method(self, parameters, arguments, data=None, source=None,
+                    project=None):
+        time.sleep(latency)
+        return {self.__class__.__name__.lower(): 'x' * payload}
+
+    def remote_method(self, parameters, arguments, data=None, source=None,
+                      project=None):
+        return generate_client_and_get_data(
+            parameters['spore'], parameters['token'], 'get_member',
+            {'id': arguments['id']})
+
+    names = ['Stub%s' % index for index in range(count)] + ['Remote']
+    for name in names:
+        module = types.ModuleType('%s.%s' % (PLUGINS_MODULE, name))
+        setattr(module, name, type(name, (object,), {
+            'members_method':
+                remote_method if name == 'Remote' else stub_method}))
+        sys.modules[module.__name__] = module
+    return names
+
+
+def sources_yaml(names, description):
+    lines = ["bench:", "    sources:", "        etab:", "            plugins:"]
+    for name in names:
+        lines += ["                %s:" % name,
+                  "                    -   spore: %s" % description,
+                  "                        token: S3CR3T"]
+    return "\n".join(lines) + "\n"
+
+
+def setup_database(names, description):
+    """ create the tables, the configurations and the user token """
+    import django
+    from django.core.management import call_command
+    from django.contrib.auth.models import User
+    from rest_framework.authtoken.models import Token
+    from django_excalibur.models import Configuration
+
+    options = {'run_syncdb': True} if django.VERSION >= (1, 9) else {}
+    call_command('migrate', verbosity=0, interactive=False, **options)
+
+    Configuration.objects.create(name="acl.yml", configuration=ACL)
+    Configuration.objects.create(name="ressources.yml",
+                                 configuration=RESSOURCES)
+    Configuration.objects.create(name="sources.yml",
+                                 configuration=sources_yaml(names,
+                                                            description))
+    user = User.objects.create(username="benchmark")
+    return Token.objects.create(user=user, key='B3NCHM4RK').key
+
+
+def make_request(token, id='32'):
+    from django.http import HttpRequest, QueryDict
+    from rest_framework.request import Request
+
+    httprequest = HttpRequest()
+    httprequest.path = "/members/method/%s.json" % id
+    httprequest.method = "GET"
+    httprequest.GET = QueryDict("project=bench&establishment=etab")
+    httprequest.META.update({
+        "REMOTE_ADDR": "127.0.0.1",
+        "SERVER_NAME": "benchmark",
+        "SERVER_PORT": 80,
+        "HTTP_AUTHORIZATION": "Token %s" % token,
+        "REQUEST_EXCALIBUR_PARAMS": {
+            "ressource": "members", "method": "method", "id": id}})
+    return Request(httprequest)
+
+
+def make_response(payload):
+    from rest_framework.response import Response
+
+    response = Response(HttpResponse())
+    response['Content-Type'] = 'application/json'
+    response.status_code = 200
+    response.content = json.dumps({'name': 'toto', 'value': 'x' * payload})
+    return response
+
+
+def scenarios(token, options):
+    """
+    the scenarios by name, each one is a function which prepares an
+    iteration and returns the function to measure
+    """
+    from django_excalibur.middleware import ExcaliburMiddleware
+    from django_excalibur.utils import ExcaliburAttack, \
+        build_route_updates_data
+
+    middleware = ExcaliburMiddleware()
+    users = [{'code': 'user%s' % index} for index in range(options.users)]
+    newdata = dict(('Stub%s' % index, {'stub%s' % index: 'x' * options.payload})
+                   for index in range(options.plugins))
+
+    def attack():
+        request, response = make_request(token), make_response(
+            options.payload)
+
+        def run():
+            excalibur = ExcaliburAttack(request, response)
+            return (excalibur.arguments, excalibur.signature,
+                    excalibur.get_request_user())
+        return run
+
+    def aggregate():
+        excalibur = ExcaliburAttack(make_request(token),
+                                    make_response(options.payload))
+        return lambda: excalibur.aggregate_data(dict(newdata))
+
+    def routes():
+        return lambda: build_route_updates_data(
+            users, 'bench', 'etab', 'members', 'code', 'http://benchmark',
+            'member-updates')
+
+    def pipeline():
+        request, response = make_request(token), make_response(
+            options.payload)
+
+        def run():
+            result = middleware.process_response(request, response)
+            if result.status_code != 200:
+                raise RuntimeError(result.content)
+            return result
+        return run
+
+    return [('attack', attack), ('aggregate_data', aggregate),
+            ('build_route_updates_data', routes),
+            ('process_response', pipeline)]
+
+
+def percentile(durations, ratio):
+    return durations[min(len(durations) - 1,
+                         int(round(ratio * (len(durations) - 1))))]
+
+
+def measure(prepare, iterations, concurrency):
+    """ run the scenario, return its numbers """
+    # warm up: configuration, runner, clients
+    for _ in range(min(iterations, 10)):
+        prepare()()
+
+    runs = [prepare() for _ in range(iterations)]
+    durations = []
+
+    def timed(run):
+        start = time.perf_counter()
+        run()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            durations = list(executor.map(timed, runs))
+    else:
+        durations = [timed(run) for run in runs]
+    total = time.perf_counter() - start
+
+    # allocations, out of the timed loop
+    peaks = []
+    for _ in range(min(iterations, 20)):
+        run = prepare()
+        tracemalloc.start()
+        run()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    durations.sort()
+    return {'iterations': iterations,
+            'rps': iterations / total if total else 0,
+            'p50_ms': percentile(durations, 0.5) * 1000,
+            'p99_ms': percentile(durations, 0.99) * 1000,
+            'peak_kb': max(peaks) / 1024.0 if peaks else 0}
+
+
+def regressions(results, baseline, threshold):
+    """ the scenarios slower than the baseline by more than the threshold """
+    found = []
+    for name, numbers in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if numbers['p50_ms'] > base['p50_ms'] * (1 + threshold):
+            found.append("%s: p50 %.3fms, baseline %.3fms" % (
+                name, numbers['p50_ms'], base['p50_ms']))
+        if numbers['rps'] < base['rps'] / (1 + threshold):
+            found.append("%s: %.0f rps, baseline %.0f rps" % (
+                name, numbers['rps'], base['rps']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="benchmarks of the excalibur middleware pipeline")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="threads sending the requests")
+    parser.add_argument('--plugins', type=int, default=3,
+                        help="stub plugins, besides the SPORE one")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="latency of the plugins and SPORE server (ms)")
+    parser.add_argument('--payload', type=int, default=100,
+                        help="size of the data of each plugin (bytes)")
+    parser.add_argument('--users', type=int, default=1000,
+                        help="users of build_route_updates_data")
+    parser.add_argument('--scenario', action='append',
+                        help="only these scenarios")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed slowdown, 0.1 for 10%%")
+    options = parser.parse_args(argv)
+
+    import django
+    django.setup()
+
+    directory = tempfile.mkdtemp()
+    try:
+        server, description = start_spore_server(options.latency / 1000.0,
+                                                 options.payload, directory)
+        names = install_plugins(options.plugins, options.latency / 1000.0,
+                                options.payload)
+        token = setup_database(names, description)
+
+        results = {}
+        print("%-26s %8s %10s %10s %10s" % ('scenario', 'rps', 'p50 ms',
+                                            'p99 ms', 'peak KB'))
+        try:
+            for name, prepare in scenarios(token, options):
+                if options.scenario and name not in options.scenario:
+                    continue
+                numbers = results[name] = measure(prepare, options.iterations,
+                                                  options.concurrency)
+                print("%-26s %8.0f %10.3f %10.3f %10.1f" % (
+                    name, numbers['rps'], numbers['p50_ms'], numbers['p99_ms'],
+                    numbers['peak_kb']))
+        finally:
+            server.shutdown()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            found = regressions(results, json.load(f), options.threshold)
+        for line in found:
+            print("REGRESSION %s" % line)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,73 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
-from django_excalibur.decorators import is_excalibur
+from django.test import RequestFactory, TestCase, override_settings
+from django_excalibur.decorators import is_excalibur, skipped
 from django_excalibur.middleware import ExcaliburMiddleware
 from django_excalibur.exceptions import excalibur_exception_handler
 from django.http import HttpRequest
 from django.http import HttpResponse
 from django.http import QueryDict
+from django.http import StreamingHttpResponse
 from rest_framework.request import Request
 from rest_framework.response import Response
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 from django_excalibur.models import Configuration
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django_excalibur.utils import ExcaliburAttack
-from django_excalibur.models import ExcaliburConf
-from excalibur.core import PluginsRunner
+from django_excalibur.utils import generate_client_and_get_data
+from django_excalibur.utils import build_route_updates_data, code_pattern,\
+    group_pattern
+from django_excalibur import spore
+from django_excalibur import jsonbackend
+from django_excalibur import tokens
+from django_excalibur.merge import merge_dict
+from excalibur.exceptions import ConfigurationLoaderError,\
+    NoACLMatchedError
+from django_excalibur.models import ExcaliburConf, new_generation,\
+    plugin_runners, load_configurations
+from excalibur.check import CheckACL
+from excalibur.conf import Acl
+from excalibur.core import PluginsRunner, Query
+from django_excalibur.runners import ExcaliburPluginsRunner, is_optional
+from django_excalibur.cache import cached_result, get_cache
+from django_excalibur.coalesce import SingleFlight, flight_key
+from django_excalibur.acl import AclIndex
+from django_excalibur import metrics
+from django_excalibur import breaker
+from django_excalibur import deadline
+import yaml
 from mock import patch, Mock
+import asyncio
+import collections
+import datetime
 import json
+import threading
+import time
+import re
+import unittest
+from io import StringIO
+import requests
 from django.conf import settings
 
+try:
+    from django.urls import re_path as url
+except ImportError:
+    # Django < 2.0
+    from django.conf.urls import url
+
+try:
+    # python 3.5+
+    from django_excalibur import aio
+except SyntaxError:
+    aio = None
+
+try:
+    from unittest.mock import AsyncMock
+except ImportError:
+    AsyncMock = None
+
 
 ACL = """
 proj:
@@ -129,6 +178,7 @@ class DecoratorIsExcaliburTest(TestCase):
     """
 
     def setUp(self):
+        skipped.clear()
         # create a mock decorator
         self.function = Mock()
         self.function.__name__ = 'mock'
@@ -187,6 +237,29 @@ class DecoratorIsExcaliburTest(TestCase):
         self.decorated_function(self.middleware, self.request, self.response)
         self.assertFalse(self.function.called)
 
+    def test_skip_path_prefixes(self):
+        self.httprequest.path = "/admin/members/"
+        self.request = Request(self.httprequest)
+        with self.settings(EXCALIBUR_SKIP_PATH_PREFIXES=['/static/',
+                                                         '/admin/']):
+            self.decorated_function(self.middleware, self.request,
+                                    self.response)
+        self.assertFalse(self.function.called)
+        self.assertEqual(skipped['path'], 1)
+
+    def test_skipped_counter(self):
+        sink = metrics.MemorySink()
+        metrics.set_sinks([sink])
+        self.response.status_code = 403
+        self.decorated_function(self.middleware, self.request, self.response)
+        self.response.status_code = 200
+        self.response['Content-Type'] = 'text/html'
+        self.decorated_function(self.middleware, self.request, self.response)
+        self.assertEqual(skipped, {'status code': 1, 'content type': 1})
+        self.assertEqual(sink.values('excalibur.skipped',
+                                     reason='status code'), [1])
+        metrics.set_sinks(None)
+
     def tearDown(self):
         self.function = None
         self.decorated_function = None
@@ -217,6 +290,388 @@ class ExceptionTest(TestCase):
                          '{"error": "FATAL ERROR"}')
 
 
+class SporeClientTest(TestCase):
+    """
+    test the pooled britney clients
+    """
+
+    description = {
+        "name": "test", "base_url": "http://myurl/", "authentication": True,
+        "methods": {"get_member": {"method": "GET", "path": "/members/{id}",
+                                   "required_params": ["id"]}}}
+
+    def setUp(self):
+        spore.clients.clear()
+        spore.session = None
+
+    def tearDown(self):
+        spore.session = None
+
+    @patch('django_excalibur.spore.get_session')
+    def test_get_description(self, get_session):
+        spore.descriptions.clear()
+        get_session.return_value.get.return_value.json.return_value = \
+            self.description
+        with self.settings(EXCALIBUR_SPORE_TIMEOUT=3):
+            for i in range(2):
+                self.assertEqual(
+                    spore.get_description('http://myurl/description.json'),
+                    self.description)
+        get_session.return_value.get.assert_called_once_with(
+            'http://myurl/description.json', timeout=3)
+        spore.descriptions.clear()
+
+    @patch('django_excalibur.spore.get_description')
+    def test_client_pool(self, get_description):
+        get_description.return_value = self.description
+        client = spore.get_client('http://myurl/description.json', 'S3CR3T')
+        self.assertIs(
+            client,
+            spore.get_client('http://myurl/description.json', 'S3CR3T'))
+        self.assertIsNot(
+            client,
+            spore.get_client('http://myurl/description.json', 'OTHER'))
+
+    @patch('django_excalibur.spore.get_description')
+    def test_client_pool_idle(self, get_description):
+        get_description.return_value = self.description
+        client = spore.get_client('http://myurl/description.json', 'S3CR3T')
+        key = ('http://myurl/description.json', 'S3CR3T')
+        spore.clients[key] = (client, spore.clients[key][1] - 3600)
+        self.assertIsNot(
+            client,
+            spore.get_client('http://myurl/description.json', 'S3CR3T'))
+
+    @patch('django_excalibur.spore.get_adapter')
+    @patch('django_excalibur.spore.get_description')
+    def test_generate_client_and_get_data(self, get_description,
+                                          get_adapter):
+        get_description.return_value = self.description
+        response = requests.models.Response()
+        response.status_code = 200
+        response._content = b'{"key": "val"}'
+        get_adapter.return_value.send.return_value = response
+        self.assertEqual(
+            generate_client_and_get_data('http://myurl/description.json',
+                                         'S3CR3T', 'get_member', {'id': 1}),
+            {"key": "val"})
+        request = get_adapter.return_value.send.call_args[0][0]
+        self.assertEqual(request.url, 'http://myurl/members/1')
+        self.assertEqual(request.headers['Authorization'], 'Token S3CR3T')
+
+    @patch('django_excalibur.spore.get_adapter')
+    @patch('django_excalibur.spore.get_description')
+    def test_generate_client_and_get_data_redirect(self, get_description,
+                                                   get_adapter):
+        get_description.return_value = self.description
+        redirect, response = requests.models.Response(), \
+            requests.models.Response()
+        redirect.status_code = 302
+        redirect.headers['Location'] = 'http://other/members/1'
+        redirect._content = b''
+        response.status_code = 200
+        response._content = b'{"key": "val"}'
+        responses = [redirect, response]
+
+        def send(request, **kwargs):
+            sent = responses.pop(0)
+            sent.request = request
+            return sent
+
+        get_adapter.return_value.send.side_effect = send
+        self.assertEqual(
+            generate_client_and_get_data('http://myurl/description.json',
+                                         'S3CR3T', 'get_member', {'id': 1}),
+            {"key": "val"})
+        request = get_adapter.return_value.send.call_args[0][0]
+        self.assertEqual(request.url, 'http://other/members/1')
+
+
+class MergeTest(TestCase):
+    """
+    test the merge strategies of the plugins data
+    """
+
+    def setUp(self):
+        self.data = {"name": "toto", "address": {"city": "Strasbourg"}}
+        self.newdata = collections.OrderedDict([
+            ('Ldapuds', {"name": "titi", "mail": "titi@uds",
+                         "address": {"city": "Paris", "zip": "67000"}}),
+            ('Apogee', {"mail": "toto@uds", "age": 18}),
+            ('Bnu', ["item1"])])
+
+    def test_referentiel_first(self):
+        self.assertEqual(
+            merge_dict(self.data, self.newdata),
+            {"name": "toto", "mail": "titi@uds", "age": 18,
+             "address": {"city": "Strasbourg"}, "Bnu": ["item1"]})
+
+    def test_plugin_first(self):
+        self.assertEqual(
+            merge_dict(self.data, self.newdata, 'plugin first'),
+            {"name": "titi", "mail": "titi@uds", "age": 18,
+             "address": {"city": "Paris", "zip": "67000"},
+             "Bnu": ["item1"]})
+
+    def test_deep(self):
+        self.assertEqual(
+            merge_dict(self.data, self.newdata, 'deep'),
+            {"name": "toto", "mail": "titi@uds", "age": 18,
+             "address": {"city": "Strasbourg", "zip": "67000"},
+             "Bnu": ["item1"]})
+
+    def test_precedence(self):
+        self.assertEqual(
+            merge_dict(self.data, self.newdata,
+                       precedence={"mail": ["Apogee", "Ldapuds"],
+                                   "name": ["Harpege", "referentiel"]}),
+            {"name": "toto", "mail": "toto@uds", "age": 18,
+             "address": {"city": "Strasbourg"}, "Bnu": ["item1"]})
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ConfigurationLoaderError):
+            merge_dict(self.data, self.newdata, 'random')
+
+
+class RouteUrls(object):
+
+    """ url configuration with a route of numeric codes """
+
+    urlpatterns = [
+        url(r'^m/(?P<memberskey>[^/]+)/(?P<memberscode>[0-9]+)'
+            r'\.(?P<format>[a-z0-9]+)$', lambda request: None, name='route'),
+    ]
+
+
+class RouteUpdatesTest(TestCase):
+
+    def reverse(self, reverse_name, kwargs, format, request):
+        return "/%s/%s/%s.%s" % (reverse_name, kwargs['memberskey'],
+                                 kwargs['memberscode'], format)
+
+    @patch('django_excalibur.utils.code_pattern',
+           Mock(return_value=re.compile(r'[a-z0-9 ]+\Z')))
+    @patch('django_excalibur.utils.reverse')
+    def test_build_route_updates_data(self, reverse):
+        reverse.side_effect = self.reverse
+        users = [{'code': 'a1'}, {'code': 'b2'}, {'nocode': 'x'},
+                 {'code': 'c 3'}, {'code': 'd4'}]
+        with patch('django_excalibur.utils.logger') as logger:
+            data = build_route_updates_data(users, 'P', 'UDS', 'members',
+                                            'code', 'http://h', 'route')
+        self.assertEqual([d['url'] for d in data],
+                         ['http://h/route/members/%s.json'
+                          '?establishment=UDS&project=P' % code
+                          for code in ('a1', 'b2', 'c 3', 'd4')])
+        # the template, its check and the code which does not fit
+        self.assertEqual(reverse.call_count, 3)
+        self.assertEqual(logger.critical.call_count, 1)
+
+    @patch('django_excalibur.utils.code_pattern',
+           Mock(return_value=re.compile(r'[a-z0-9]+\Z')))
+    @patch('django_excalibur.utils.reverse')
+    def test_build_route_updates_data_wrong_template(self, reverse):
+        # the code json is also in the suffix
+        reverse.side_effect = self.reverse
+        users = [{'code': 'json'}, {'code': 'b2'}, {'code': 'c3'}]
+        data = build_route_updates_data(users, 'P', 'UDS', 'members',
+                                        'code', '', 'r')
+        self.assertEqual([d['url'].split('?')[0] for d in data],
+                         ['/r/members/json.json', '/r/members/b2.json',
+                          '/r/members/c3.json'])
+
+    def test_group_pattern(self):
+        self.assertEqual(group_pattern(
+            r'^m/(?P<memberscode>(\d+|[(]x\))[a-z]?)\.json$', 'memberscode'),
+            r'(\d+|[(]x\))[a-z]?')
+        self.assertIsNone(group_pattern(r'^m/(?P<id>\d+)$', 'memberscode'))
+
+    @override_settings(ROOT_URLCONF=RouteUrls)
+    def test_build_route_updates_data_pattern(self):
+        self.assertEqual(code_pattern('route').pattern, '(?:[0-9]+)\\Z')
+        users = [{'code': '12'}, {'code': 'abc'}, {'code': '34'}]
+        with patch('django_excalibur.utils.logger') as logger:
+            data = build_route_updates_data(users, 'P', 'UDS', 'members',
+                                            'code', 'http://h', 'route')
+        # the code which does not match the route is skipped
+        self.assertEqual([d['url'].split('?')[0] for d in data],
+                         ['http://h/m/members/12.json',
+                          'http://h/m/members/34.json'])
+        self.assertEqual(logger.critical.call_count, 1)
+
+
+class AclIndexTest(TestCase):
+
+    def test_is_allowed(self):
+        index = AclIndex(yaml.load(ACL))
+        self.assertTrue(index.is_allowed('proj', ['myetab'], 'members',
+                                         'method1'))
+        self.assertFalse(index.is_allowed('proj', ['myetab2'], 'members',
+                                          'method1'))
+        # one of the sources allows the method
+        self.assertTrue(index.is_allowed('proj', ['myetab', 'myetab2'],
+                                         'members', 'method1'))
+        # all the sources must be in the acl
+        self.assertFalse(index.is_allowed('proj', ['myetab', 'other'],
+                                          'members', 'method1'))
+        self.assertFalse(index.is_allowed('other', ['myetab'], 'members',
+                                          'method1'))
+
+    def test_is_allowed_without_project(self):
+        index = AclIndex({'myetab': {'members': ['method1']}})
+        self.assertTrue(index.is_allowed(None, ['myetab'], 'members',
+                                         'method1'))
+        self.assertFalse(index.is_allowed('proj', ['myetab'], 'members',
+                                          'method1'))
+
+    def test_is_allowed_default_project(self):
+        acl = yaml.load(ACL.replace('proj:', 'default:'))
+        index = AclIndex(acl)
+        excalibur_acl = Acl()
+        excalibur_acl.__dict__.update(acl)
+        query = Mock(project='', source='myetab', ressource='members',
+                     method='method1')
+        # same answers as the excalibur check
+        CheckACL(query, None, {'myetab': {}}, excalibur_acl)()
+        self.assertTrue(index.is_allowed('', ['myetab'], 'members',
+                                         'method1'))
+        query.method = 'method4'
+        self.assertRaises(NoACLMatchedError, CheckACL(
+            query, None, {'myetab': {}}, excalibur_acl))
+        self.assertFalse(index.is_allowed('', ['myetab'], 'members',
+                                          'method4'))
+
+
+class MetricsTest(TestCase):
+
+    def test_prometheus_sink(self):
+        sink = metrics.PrometheusSink()
+        sink.record('timing', 'excalibur.plugin', 0.02, {'plugin': 'Apogee'})
+        sink.record('count', 'excalibur.errors', 1, {'error': 'A"B'})
+        sink.record('count', 'excalibur.errors', 2, {'error': 'A"B'})
+        text = sink.render()
+        self.assertIn('# TYPE excalibur_plugin_seconds histogram', text)
+        self.assertIn('excalibur_plugin_seconds_bucket{plugin="Apogee",'
+                      'le="0.01"} 0', text)
+        self.assertIn('excalibur_plugin_seconds_bucket{plugin="Apogee",'
+                      'le="0.025"} 1', text)
+        self.assertIn('excalibur_plugin_seconds_count{plugin="Apogee"} 1',
+                      text)
+        self.assertIn('excalibur_errors_total{error="A\\"B"} 3', text)
+
+    def test_statsd_sink(self):
+        sink = metrics.StatsdSink(prefix='api.')
+        sink.socket = Mock()
+        sink.record('timing', 'excalibur.plugin', 0.5,
+                    {'plugin': 'Apogee', 'method': 'members_method2'})
+        sink.socket.sendto.assert_called_once_with(
+            b'api.excalibur.plugin.members_method2.Apogee:500.0|ms',
+            ('localhost', 8125))
+
+    def test_failing_sink(self):
+        sink = Mock()
+        sink.record.side_effect = Exception()
+        memory = metrics.MemorySink()
+        metrics.set_sinks([sink, memory])
+        metrics.increment('excalibur.errors', error='Error')
+        self.assertEqual(memory.values('excalibur.errors'), [1])
+
+    def tearDown(self):
+        metrics.set_sinks(None)
+
+
+class CircuitBreakerTest(TestCase):
+
+    @patch('django_excalibur.breaker.time')
+    def test_states(self, time):
+        time.time.return_value = 100
+        circuit = breaker.CircuitBreaker(2, 30)
+        circuit.failure()
+        self.assertTrue(circuit.allow())
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        self.assertFalse(circuit.allow())
+        # one try after the reset timeout
+        time.time.return_value = 130
+        self.assertTrue(circuit.allow())
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+        self.assertFalse(circuit.allow())
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        time.time.return_value = 160
+        self.assertTrue(circuit.allow())
+        circuit.success()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+        self.assertTrue(circuit.allow())
+
+
+class DeadlineTest(TestCase):
+
+    def test_get_budget(self):
+        ressources = {'members': {'method1': {'deadline': 2},
+                                  'method2': {}}}
+        self.assertEqual(deadline.get_budget(ressources, 'members',
+                                             'method1'), 2)
+        self.assertIsNone(deadline.get_budget(ressources, 'members',
+                                              'method2'))
+        with self.settings(EXCALIBUR_DEADLINE=5):
+            self.assertEqual(deadline.get_budget(ressources, 'members',
+                                                 'method2'), 5)
+
+    @patch('django_excalibur.deadline.time')
+    def test_timeout(self, time):
+        time.time.return_value = 100
+        self.assertEqual(deadline.timeout(10), 10)
+        with deadline.use_deadline(102):
+            self.assertEqual(deadline.timeout(10), 2)
+            self.assertEqual(deadline.timeout(), 2)
+            self.assertFalse(deadline.expired())
+            time.time.return_value = 103
+            self.assertTrue(deadline.expired())
+        self.assertIsNone(deadline.remaining())
+
+    def test_generate_client_and_get_data_expired(self):
+        with deadline.use_deadline(1):
+            self.assertRaises(deadline.DeadlineExceededError,
+                              generate_client_and_get_data,
+                              'desc.json', 'S3CR3T', 'get_user', {})
+
+    def test_cached_result_wait(self):
+        get_cache().clear()
+        get_cache().add('key:lock', 1, 10)
+        compute = Mock(return_value=({}, {}))
+        start = time.time()
+        with deadline.use_deadline(start + 0.2):
+            self.assertRaises(deadline.DeadlineExceededError,
+                              cached_result, 'key', 60, compute)
+        # the lock timeout is 10s
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(compute.called)
+        get_cache().clear()
+
+
+class CoalesceTest(TestCase):
+
+    def test_flight_key(self):
+        fields = dict(project='proj', source='myetab', ressource='members',
+                      method='method2', request_method='GET',
+                      arguments={'login': 'bob'}, signature='sig1')
+        query, other = Mock(**fields), Mock(**fields)
+        key = flight_key(query)
+        other.signature = 'sig2'
+        self.assertEqual(key, flight_key(other))
+        # the sources of "all" depend on the signature
+        query.source = other.source = 'all'
+        self.assertNotEqual(flight_key(query), flight_key(other))
+
+    def test_single_flight_error(self):
+        flights = SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.run('key', Mock(side_effect=ValueError))
+        self.assertEqual(flights.flights, {})
+        self.assertEqual(flights.run('key', lambda: 1), (1, False))
+
+
 class ConfigurationModelTest(TestCase):
     """
     test for the configuration Model
@@ -245,10 +700,142 @@ class ConfigurationModelTest(TestCase):
             Configuration.objects.create(name="error.notayml",
                                          configuration="iamnoymal\t")
 
+    def test_parsed(self):
+        conf = Configuration.objects.get(name="sources.yml")
+        self.assertEqual(json.loads(conf.parsed), yaml.load(SOURCES))
+        self.assertEqual(len(conf.checksum), 40)
+        self.assertEqual(conf.content(), yaml.load(SOURCES))
+        # an outdated parsed configuration is not used
+        conf.configuration = ACL
+        self.assertEqual(conf.content(), yaml.load(ACL))
+
+    def test_parsed_date(self):
+        conf = Configuration.objects.create(name="dates.yml",
+                                            configuration="since: 2015-01-01")
+        self.assertIsNone(conf.parsed)
+        self.assertEqual(conf.content(),
+                         {'since': datetime.date(2015, 1, 1)})
+
+    def test_schema_error(self):
+        with self.assertRaises(ValidationError):
+            Configuration.objects.create(name="ressources.yml",
+                                         configuration="members: [1, 2]")
+        self.conf_sources.configuration = "etab:\n    nothing: {}"
+        with self.assertRaises(ValidationError):
+            self.conf_sources.save()
+        # the request method is optional
+        self.conf_ressources.configuration = "members:\n    m1:\n" \
+            "        arguments:"
+        self.conf_ressources.save()
+        self.conf_ressources.configuration = "members:\n    m1:\n" \
+            "        request method: [GET]"
+        with self.assertRaises(ValidationError):
+            self.conf_ressources.save()
+
     def test_excalibur_conf(self):
         ExcaliburConf()
         self.assertIsNotNone(ExcaliburConf.instance)
 
+    def test_excalibur_conf_single_query(self):
+        with self.assertNumQueries(1):
+            ExcaliburConf()
+        ExcaliburConf.removeInstance()
+        self.conf_acl.delete()
+        with self.assertRaises(Configuration.DoesNotExist):
+            ExcaliburConf()
+
+    def test_excalibur_conf_single_flight(self):
+        configurations = load_configurations(
+            settings.EXCALIBUR_SOURCES, settings.EXCALIBUR_RESSOURCES,
+            settings.EXCALIBUR_ACL)
+
+        def slow_load(*names):
+            time.sleep(0.05)
+            return configurations
+
+        with patch('django_excalibur.models.load_configurations',
+                   side_effect=slow_load) as load:
+            threads = [threading.Thread(target=ExcaliburConf)
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(load.call_count, 1)
+        with self.assertRaises(AttributeError):
+            ExcaliburConf().version = None
+
+    def test_warm_up_command(self):
+        out = StringIO()
+        call_command('excalibur_warm_up', stdout=out)
+        self.assertIn(ExcaliburConf().version, out.getvalue())
+        self.assertIn((ExcaliburConf().version, True), plugin_runners)
+        self.conf_sources.delete()
+        with self.assertRaises(CommandError):
+            call_command('excalibur_warm_up', stdout=out)
+
+    def test_excalibur_conf_plugin_runner(self):
+        runner = ExcaliburConf().get_plugin_runner()
+        self.assertIsInstance(runner, PluginsRunner)
+        self.assertIs(runner, ExcaliburConf().get_plugin_runner())
+        self.assertIsNot(runner, ExcaliburConf().get_plugin_runner(
+            check_signature=False))
+        # a new configuration version builds a new runner
+        self.conf_acl.configuration = ACL + "\n"
+        self.conf_acl.save()
+        self.assertIsNot(runner, ExcaliburConf().get_plugin_runner())
+
+    def test_excalibur_conf_old_runner(self):
+        with self.settings(EXCALIBUR_MAX_WORKERS=3):
+            runner = ExcaliburConf().get_plugin_runner()
+            self.conf_acl.configuration = ACL + "\n"
+            self.conf_acl.save()
+            self.assertIsNot(runner, ExcaliburConf().get_plugin_runner())
+        # a request which got the old runner before the change can use it
+        plugin_mock = Mock()
+        plugin_mock.return_value.members_method2.return_value = {"key": "v"}
+        query = Query('myetab', '127.0.0.1', 'members', 'method2', 'GET',
+                      project='proj', arguments={'login': 'bob'})
+        with patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE,
+                   plugin_mock), \
+                patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE,
+                      plugin_mock), \
+                patch('%s.Ldapuds.Ldapuds' %
+                      settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock):
+            data, errors = runner.run(query)
+        self.assertEqual(errors, {})
+        self.assertEqual(len(data), 3)
+
+    def test_excalibur_conf_generation(self):
+        conf = ExcaliburConf()
+        # another process saves a configuration
+        Configuration.objects.filter(name="acl.yml").update(
+            configuration=ACL + "\n")
+        new_generation()
+        self.assertIs(conf, ExcaliburConf())
+        # reloaded after the check interval
+        conf.checked_at -= 60
+        new_conf = ExcaliburConf()
+        self.assertIsNot(conf, new_conf)
+        new_conf.checked_at -= 60
+        self.assertIs(new_conf, ExcaliburConf())
+
+    def test_excalibur_conf_generation_rolled_back(self):
+        # the generation of a change not committed yet
+        Configuration.objects.filter(name="acl.yml").update(
+            configuration=ACL + "\n")
+        new_generation()
+        Configuration.objects.filter(name="acl.yml").update(
+            configuration=ACL)
+        conf = ExcaliburConf()
+        conf.checked_at -= 60
+        # loaded again, the change can be committed since
+        new_conf = ExcaliburConf()
+        self.assertIsNot(conf, new_conf)
+        # the same configuration again, the change was rolled back
+        new_conf.checked_at -= 60
+        self.assertIs(new_conf, ExcaliburConf())
+
     def tearDown(self):
         ExcaliburConf.removeInstance()
 
@@ -378,6 +965,146 @@ project=sigb&establishment=uds"
             {'Harpege': {'key1': 'val1'}, 'Ldapuds': {'key3': 'val3'},
              'Apogee': {'key2': 'val2'}})
 
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_make_and_run_query_concurrent(self):
+
+        plugin_runner = ExcaliburPluginsRunner(
+            self.excconf.acl_conf.configuration,
+            self.excconf.sources_conf.configuration,
+            self.excconf.ressource_conf.configuration,
+            self.excconf.plugins_module,
+            raw_yaml_content=True,
+            max_workers=3,
+            plugin_timeout=5
+        )
+
+        newdata, errors = self.attack.make_and_run_query(plugin_runner)
+
+        self.assertEqual(errors, {})
+        # same order as the sequential run
+        self.assertEqual(
+            list(newdata.keys()),
+            list(plugin_runner.plugins('myetab', None,
+                                       project='proj').keys()))
+        self.assertEqual(
+            newdata,
+            {'Harpege': {'key1': 'val1'}, 'Ldapuds': {'key3': 'val3'},
+             'Apogee': {'key2': 'val2'}})
+
+    def test_make_and_run_query_queued(self):
+        plugin_mock = Mock()
+
+        def slow_method(*args, **kwargs):
+            time.sleep(0.05)
+            return {"key": "v"}
+
+        plugin_mock.return_value.members_method2.side_effect = slow_method
+        plugin_runner = ExcaliburPluginsRunner(
+            self.excconf.acl_conf.configuration,
+            self.excconf.sources_conf.configuration,
+            self.excconf.ressource_conf.configuration,
+            self.excconf.plugins_module,
+            raw_yaml_content=True,
+            max_workers=2,
+            plugin_timeout=0.2
+        )
+        # the workers are busy with other requests
+        for i in range(2):
+            plugin_runner.executor.submit(time.sleep, 0.3)
+
+        with patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE,
+                   plugin_mock), \
+                patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE,
+                      plugin_mock), \
+                patch('%s.Ldapuds.Ldapuds' %
+                      settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock):
+            newdata, errors = self.attack.make_and_run_query(plugin_runner)
+
+        # the plugin timeout starts with the plugin
+        self.assertEqual(errors, {})
+        self.assertEqual(len(newdata), 3)
+
+    def test_plugin_timeout_without_workers(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ExcaliburPluginsRunner(
+                self.excconf.acl_conf.configuration,
+                self.excconf.sources_conf.configuration,
+                self.excconf.ressource_conf.configuration,
+                self.excconf.plugins_module,
+                raw_yaml_content=True,
+                plugin_timeout=1
+            )
+
+    def test_make_and_run_query_cached(self):
+        get_cache().clear()
+        plugin_mock = Mock()
+        plugin_mock.return_value.members_method2.return_value = {"key": "v"}
+
+        plugin_runner = ExcaliburPluginsRunner(
+            self.excconf.acl_conf.configuration,
+            SOURCES.replace("token: S3CR3T", "token: S3CR3T\n"
+                            "                        cache ttl: 60"),
+            self.excconf.ressource_conf.configuration,
+            self.excconf.plugins_module,
+            raw_yaml_content=True
+        )
+
+        with patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE,
+                   plugin_mock), \
+                patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE,
+                      plugin_mock), \
+                patch('%s.Ldapuds.Ldapuds' %
+                      settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock):
+            first = self.attack.make_and_run_query(plugin_runner)
+            second = self.attack.make_and_run_query(plugin_runner)
+
+        self.assertEqual(first, second)
+        self.assertEqual(
+            plugin_mock.return_value.members_method2.call_count, 3)
+
+    def test_make_and_run_query_coalesced(self):
+        plugin_mock = Mock()
+
+        def slow_method(*args, **kwargs):
+            time.sleep(0.1)
+            return {"key": "v"}
+
+        plugin_mock.return_value.members_method2.side_effect = slow_method
+        plugin_runner = ExcaliburPluginsRunner(
+            self.excconf.acl_conf.configuration,
+            self.excconf.sources_conf.configuration,
+            self.excconf.ressource_conf.configuration,
+            self.excconf.plugins_module,
+            raw_yaml_content=True,
+            coalesce=True
+        )
+        results = []
+
+        def run():
+            results.append(self.attack.make_and_run_query(plugin_runner))
+
+        with patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE,
+                   plugin_mock), \
+                patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE,
+                      plugin_mock), \
+                patch('%s.Ldapuds.Ldapuds' %
+                      settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock):
+            threads = [threading.Thread(target=run) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result == results[0] for result in results))
+        # one run of the 3 plugins for the 4 queries
+        self.assertEqual(
+            plugin_mock.return_value.members_method2.call_count, 3)
+        # each query has its own data
+        self.assertIsNot(results[0][0], results[1][0])
+
     @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock8)
     @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock8)
     @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock8)
@@ -418,6 +1145,32 @@ project=sigb&establishment=uds"
             {"key3": "val3", "key2": "val2", "age": 18,
              "name": "toto", "key1": "prioritary"})
 
+    def test_aggregate_data_nothing_to_merge(self):
+        response = self.attack.aggregate_data({})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content,
+                         b'{"key1":"prioritary","name":"toto","age":18}')
+
+    def test_json_backend(self):
+        with self.settings(EXCALIBUR_JSON_BACKEND='notinstalled'):
+            jsonbackend.backend = None
+            self.assertIs(jsonbackend.get_backend(), json)
+            self.assertEqual(jsonbackend.loads(b'{"key": "val"}'),
+                             {"key": "val"})
+        jsonbackend.backend = None
+
+    def test_json_backend_fallback(self):
+        # a fast backend which cannot encode big ints
+        orjson = Mock(__name__='orjson', OPT_NON_STR_KEYS=1,
+                      dumps=Mock(side_effect=TypeError))
+        jsonbackend.backend = orjson
+        try:
+            self.assertEqual(jsonbackend.dumps({1: 2 ** 70}),
+                             '{"1": 1180591620717411303424}')
+            orjson.dumps.assert_called_with({1: 2 ** 70}, option=1)
+        finally:
+            jsonbackend.backend = None
+
     @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
     @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
     @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
@@ -499,6 +1252,21 @@ project=sigb&establishment=uds"
             ["item99", "item98", "item1", "item2", "item5", "item6",
              "item3", "item4"].sort())
 
+    def test_aggregate_data_streaming(self):
+        self.response.content = '["item99", "item98"]'
+        self.attack = ExcaliburAttack(self.request, self.response)
+
+        with self.settings(EXCALIBUR_STREAMING_THRESHOLD=0):
+            response = self.attack.aggregate_data(
+                {'Harpege': ['item1', 'item2'], 'Apogee': {'key2': 'val2'}})
+
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content).decode('utf-8')),
+            ["item99", "item98", "item1", "item2", {'key2': 'val2'}])
+
     @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock4)
     @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock5)
     @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock6)
@@ -544,6 +1312,95 @@ project=sigb&establishment=uds"
         self.assertEqual(response.status_code, 500)
         self.assertTrue('error' in json.loads(
             response.content.decode('utf-8')).keys())
+        # all the errors are reported
+        self.assertEqual(
+            sorted(json.loads(response.content.decode('utf-8'))[
+                '_excalibur_errors']),
+            ['Apogee', 'Harpege', 'Ldapuds'])
+
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock8)
+    def test_middleware_partial(self):
+        with self.settings(EXCALIBUR_PARTIAL=True):
+            response = self.middleware.process_response(self.request,
+                                                        self.response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Excalibur-Partial'], 'Ldapuds')
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(content['key2'], 'val2')
+        self.assertEqual(content['_excalibur_errors']['Ldapuds']['error'],
+                         'Exception')
+
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_middleware_deadline(self):
+        with self.settings(EXCALIBUR_DEADLINE=1e-9), \
+                patch.object(ExcaliburPluginsRunner, 'call_plugin') as call:
+            response = self.middleware.process_response(self.request,
+                                                        self.response)
+        self.assertFalse(call.called)
+        errors = json.loads(response.content.decode('utf-8'))[
+            '_excalibur_errors']
+        self.assertEqual(set(error['error'] for error in errors.values()),
+                         set(['DeadlineExceededError']))
+
+    @unittest.skipUnless(aio and AsyncMock, "async python")
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_async_middleware(self):
+        async_plugin = Mock()
+        async_plugin.return_value.members_method2 = AsyncMock(
+            return_value={"key2": "async"})
+        # no database access out of the test thread
+        self.attack.get_request_user()
+        middleware = aio.AsyncExcaliburMiddleware(
+            AsyncMock(return_value=self.response))
+        loop = asyncio.new_event_loop()
+        try:
+            with patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE,
+                       async_plugin):
+                response = loop.run_until_complete(middleware(self.request))
+        finally:
+            loop.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8')),
+            {"key3": "val3", "age": 18, "key1": "prioritary",
+             "name": "toto", "key2": "async"})
+
+    @unittest.skipUnless(aio, "async python")
+    def test_async_batch_max_workers(self):
+        running, most = [0], [0]
+
+        async def run_query(plugin_runner, query):
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            return {'id': query}, {}
+
+        excalibur = Mock(ids=list(range(6)))
+        excalibur.make_batch_query.side_effect = lambda id: id
+        loop = asyncio.new_event_loop()
+        try:
+            with patch('django_excalibur.aio.run_query', run_query), \
+                    self.settings(EXCALIBUR_BATCH_MAX_WORKERS=2):
+                results = loop.run_until_complete(
+                    aio.run_batch(excalibur, None))
+        finally:
+            loop.close()
+        self.assertEqual(list(results), list(range(6)))
+        self.assertEqual(results[5], ({'id': 5}, {}))
+        self.assertEqual(most[0], 2)
+
+    def test_is_optional(self):
+        self.assertFalse(is_optional([{'spore': 'x'}]))
+        self.assertTrue(is_optional([{'spore': 'x', 'optional': True}]))
+        with self.settings(EXCALIBUR_PARTIAL=True):
+            self.assertTrue(is_optional([{'spore': 'x'}]))
+            self.assertFalse(is_optional([{'spore': 'x', 'required': True}]))
 
     @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
     @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
@@ -557,6 +1414,24 @@ project=sigb&establishment=uds"
             {"key3": "val3", "age": 18, "key1": "prioritary",
              "name": "toto", "key2": "val2"})
 
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_middleware_without_request_attribute(self):
+        # a request of Django 1.9+, without REQUEST
+        request = RequestFactory().get(
+            '/members/32/', {'project': 'proj', 'establishment': 'myetab'},
+            HTTP_AUTHORIZATION=self.httprequest.META["HTTP_AUTHORIZATION"])
+        request.META['REQUEST_EXCALIBUR_PARAMS'] = dict(
+            self.httprequest.META['REQUEST_EXCALIBUR_PARAMS'])
+        self.assertFalse(hasattr(request, 'REQUEST'))
+        response = self.middleware.process_response(request, self.response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8')),
+            {"key3": "val3", "age": 18, "key1": "prioritary",
+             "name": "toto", "key2": "val2"})
+
     @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
     @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
     @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
@@ -572,6 +1447,101 @@ project=sigb&establishment=uds"
             {"name": "toto", "key3": "val3", "key2": "val2",
              "age": 18, "key1": "prioritary", "key11": "val11"})
 
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock8)
+    def test_middleware_metrics(self):
+        sink = metrics.MemorySink()
+        metrics.set_sinks([sink])
+        plugin_runners.clear()
+        self.middleware.process_response(self.request, self.response)
+        self.assertEqual(len(sink.values('excalibur.request',
+                                         ressource='members',
+                                         method='method2')), 1)
+        self.assertEqual(len(sink.values('excalibur.plugin', plugin='Apogee',
+                                         method='members_method2')), 1)
+        self.assertEqual(sink.values('excalibur.plugin.errors',
+                                     plugin='Ldapuds', error='Exception'),
+                         [1])
+        self.assertEqual(len(sink.values('excalibur.runner.build')), 1)
+
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_middleware_server_timing(self):
+        response = self.middleware.process_response(self.request,
+                                                    self.response)
+        self.assertNotIn('Server-Timing', response)
+
+        self.response = Response(HttpResponse())
+        self.response['Content-Type'] = 'application/json'
+        self.response.content = '{"name": "toto"}'
+        with self.settings(EXCALIBUR_SERVER_TIMING=True):
+            response = self.middleware.process_response(self.request,
+                                                        self.response)
+        steps = [step.split(';')[0]
+                 for step in response['Server-Timing'].split(', ')]
+        self.assertEqual(steps[:3], ['token', 'conf', 'runner'])
+        self.assertEqual(sorted(steps[3:6]), ['plugin-Apogee',
+                                              'plugin-Harpege',
+                                              'plugin-Ldapuds'])
+        self.assertEqual(steps[6:], ['aggregate', 'excalibur'])
+
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_middleware_breaker(self):
+        content = self.response.content
+        with self.settings(EXCALIBUR_BREAKER_FAILURES=1,
+                           EXCALIBUR_BREAKER_FALLBACK_TTL=60):
+            self.middleware.process_response(self.request, self.response)
+            with patch('%s.Ldapuds.Ldapuds' %
+                       settings.EXCALIBUR_PLUGINS_MODULE, self.plugin_mock8):
+                self.response.content = content
+                response = self.middleware.process_response(
+                    self.request, self.response)
+                self.assertEqual(response.status_code, 500)
+                # open circuit, the last good data are used
+                self.response.content = content
+                self.response.status_code = 200
+                response = self.middleware.process_response(
+                    self.request, self.response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Excalibur-Partial'], 'Ldapuds')
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['key3'],
+                         'val3')
+
+    @patch.object(ExcaliburPluginsRunner, 'run')
+    def test_middleware_acl_denied(self, run):
+        self.httprequest.GET = QueryDict("project=proj&establishment=myetab2")
+        self.httprequest.REQUEST = self.httprequest.GET
+        self.httprequest.META['REQUEST_EXCALIBUR_PARAMS']['method'] = \
+            "method1"
+        response = self.middleware.process_response(self.request,
+                                                    self.response)
+        self.assertIn('NoACLMatchedError', json.loads(
+            response.content.decode('utf-8'))['error'])
+        self.assertFalse(run.called)
+
+    @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
+    @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
+    @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
+    def test_middleware_batch(self):
+        # the last id is too long for the ressource checks
+        self.httprequest.META['REQUEST_EXCALIBUR_PARAMS']["ids"] = [
+            "32", "33", "32", "9" * 60]
+        self.response.content = '{"32": {"key1": "prioritary"}}'
+        response = self.middleware.process_response(self.request,
+                                                    self.response)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(
+            data["32"],
+            {"key1": "prioritary", "key2": "val2", "key3": "val3"})
+        self.assertEqual(
+            data["33"], {"key1": "val1", "key2": "val2", "key3": "val3"})
+        self.assertIn("ArgumentError", data["9" * 60]["error"])
+
     @patch('%s.Harpege.Harpege' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock1)
     @patch('%s.Apogee.Apogee' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock2)
     @patch('%s.Ldapuds.Ldapuds' % settings.EXCALIBUR_PLUGINS_MODULE, plugin_mock3)
@@ -598,5 +1568,46 @@ project=sigb&establishment=uds"
         self.assertEqual(json.loads(response.content.decode('utf-8')),
                          {"error": "not found"})
 
+    def test_middleware_no_auth_lazy(self):
+        # the content is never decoded without user
+        self.response.content = "not json"
+        self.request.META.pop("HTTP_AUTHORIZATION", None)
+        response = self.middleware.process_response(self.request,
+                                                    self.response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"not json")
+
+    def test_get_request_user_cached(self):
+        self.assertEqual(self.attack.get_request_user(), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                ExcaliburAttack(self.request,
+                                self.response).get_request_user(),
+                self.user)
+        self.token.delete()
+        self.assertIsNone(
+            ExcaliburAttack(self.request, self.response).get_request_user())
+
+    def test_get_request_user_changed(self):
+        self.assertFalse(self.attack.get_request_user().is_superuser)
+        self.user.is_superuser = True
+        self.user.save()
+        # read again after a change of the user
+        self.assertTrue(ExcaliburAttack(
+            self.request, self.response).get_request_user().is_superuser)
+
+    def test_get_request_user_authenticated(self):
+        # token already resolved by the rest framework authentication
+        self.httprequest.auth = Token.objects.select_related('user').get(
+            user=self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                ExcaliburAttack(self.httprequest,
+                                self.response).get_request_user(),
+                self.user)
+
     def tearDown(self):
         ExcaliburConf.removeInstance()
+        tokens.users.clear()
+        metrics.set_sinks(None)
+        breaker.breakers.clear()
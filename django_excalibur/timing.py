@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import collections
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Server-Timing header of the excalibur responses
+
+With EXCALIBUR_SERVER_TIMING, the middleware tells in the Server-Timing
+header the time spent in the token lookup, the configuration load, the
+runner build, each plugin and the aggregation, in milliseconds::
+
+    Server-Timing: token;dur=0.4, conf;dur=0.1, runner;dur=0.0,
+        plugin-Apogee;dur=12.3, aggregate;dur=1.2, excalibur;dur=14.5
+
+"""
+
+# characters not allowed in a metric name
+NOT_TOKEN = re.compile(r"[^!#$%&'*+.^_`|~0-9A-Za-z-]")
+
+
+class ServerTiming(object):
+
+    """
+    durations of a request by step, the steps measured several times (a
+    plugin of a batch) are summed
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.durations = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        """ add the duration of a step """
+        if self.enabled:
+            with self.lock:
+                self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def add_plugin(self, plugin_name, seconds):
+        """ add the duration of a plugin call """
+        self.add('plugin-' + NOT_TOKEN.sub('_', plugin_name), seconds)
+
+    @contextmanager
+    def measure(self, name):
+        """ measure the duration of the block """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def header(self):
+        """ the Server-Timing header value """
+        with self.lock:
+            return ", ".join("%s;dur=%.1f" % (name, seconds * 1000)
+                             for name, seconds in self.durations.items())
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from rest_framework.authtoken.models import Token
+
+"""
+Users of the rest framework tokens, kept EXCALIBUR_TOKEN_CACHE_TTL seconds
+in the process
+
+A changed or deleted token or user is forgotten at once in the process
+which changes it, the other processes use the cached user until the end of
+its TTL: a revoked superuser can skip the signature checks during this
+time, set a short TTL (or 0 to disable the cache) if it matters.
+
+"""
+
+users = {}
+lock = threading.Lock()
+
+
+def get_token_user(key):
+    """
+    get the user of a token key, None if the token does not exist
+    """
+    now = time.time()
+    cached = users.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    try:
+        user = Token.objects.select_related('user').get(key=key).user
+    except ObjectDoesNotExist:
+        # not cached, a new token can be used at once
+        return None
+
+    ttl = getattr(settings, 'EXCALIBUR_TOKEN_CACHE_TTL', 60)
+    size = getattr(settings, 'EXCALIBUR_TOKEN_CACHE_SIZE', 1000)
+    if ttl:
+        with lock:
+            if len(users) >= size:
+                for old_key in [k for k, v in users.items() if v[1] <= now]:
+                    del users[old_key]
+                if len(users) >= size:
+                    users.clear()
+            users[key] = (user, now + ttl)
+
+    return user
+
+
+def forget_token(key):
+    """ remove a token from the cache """
+    if isinstance(key, bytes):
+        key = str(key, 'utf-8')
+    with lock:
+        users.pop(key, None)
+
+
+def forget_user(user_id):
+    """ remove the tokens of a user from the cache """
+    with lock:
+        for key in [k for k, v in users.items() if v[0].pk == user_id]:
+            del users[key]
@@ -1,17 +1,32 @@
 # -*- coding: utf-8 -*-
+import collections
 import hashlib
-import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from excalibur.core import Query
-from excalibur.exceptions import ExcaliburError
+from excalibur.exceptions import ExcaliburError, PluginRunnerError
+from excalibur.utils import format_error
 import logging
-from .exceptions import excalibur_exception_handler
+from .exceptions import excalibur_exception_handler, ERRORS_KEY
+from . import jsonbackend
+from . import metrics
+from .deadline import DeadlineExceededError, expired
+from .decorators import request_args
+from .merge import merge_dict, merge_list
+from .spore import get_client
+from .timing import ServerTiming
+from .tokens import get_token_user
 from rest_framework.authtoken.models import Token
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
 from britney.errors import SporeMethodStatusError, SporeMethodCallError
-from britney.middleware import auth
-import britney_utils
 from rest_framework.reverse import reverse
-from django.core.urlresolvers import NoReverseMatch
+try:
+    from django.urls import NoReverseMatch, get_resolver
+except ImportError:
+    # Django < 1.10
+    from django.core.urlresolvers import NoReverseMatch, get_resolver
 
 
 """
@@ -21,37 +36,35 @@ Tools for the excalibur middleware
 
 logger = logging.getLogger(__name__)
 
+# member codes which are the same in an url
+SIMPLE_CODE = re.compile(r'^[A-Za-z0-9_.~-]+$')
+
 
 class ExcaliburAttack():
 
     """
-    params for excalibur
+    params for excalibur, computed on first access
     """
 
     def __init__(self, request, response):
         # base attribute
         self.request = request
         self.response = response
-        # secondary attribute (use request and response)
-        self.arguments = self.__arguments()
-        self.ressource = self.__ressource()
-        self.token = self.__token()
-        self.remote_ip = self.__remote_ip()
-        self.request_method = self.__request_method()
-        self.project = self.__project()
-        self.source = self.__source()
-        self.data = self.__data()
-        self.method = self.__method()
-        # signature needs all other params to be set
-        self.signature = self.__signature()
-
-    def __arguments(self):
+        # time.time() after which the plugins are skipped
+        self.deadline = None
+
+    @cached_property
+    def arguments(self):
         """ get arguments id from the path """
+        return self.arguments_for(self.__find_id())
+
+    def arguments_for(self, id):
+        """ get the arguments of an id """
         try:
             arguments = {}
-            arguments["id"] = self. __find_id()
-            arguments["project"] = self.__project()
-            arguments["establishment"] = self.__source()
+            arguments["id"] = id
+            arguments["project"] = self.project
+            arguments["establishment"] = self.source
             arguments["base_url"] = self.__find_base_url()
             arguments.update(self.__optionnal_args())
         except IndexError:
@@ -67,89 +80,145 @@ class ExcaliburAttack():
     def __find_id(self):
         return self.request.META["REQUEST_EXCALIBUR_PARAMS"]["id"]
 
-    def __ressource(self):
+    @cached_property
+    def ids(self):
+        """ get the ids of a batch from the path, without duplicates """
+        ids = self.request.META["REQUEST_EXCALIBUR_PARAMS"].get("ids")
+        return list(collections.OrderedDict.fromkeys(
+            str(id) for id in ids)) if ids else None
+
+    @cached_property
+    def ressource(self):
         """ get the ressource from the path """
         try:
             return self.request.META["REQUEST_EXCALIBUR_PARAMS"]["ressource"]
         except KeyError:
             return None
 
-    def __method(self):
+    @cached_property
+    def method(self):
         """ get the method from the path """
         try:
             return self.request.META["REQUEST_EXCALIBUR_PARAMS"]["method"]
         except KeyError:
             return None
 
-    def __token(self):
+    @cached_property
+    def token(self):
         """ get the token from the request header """
         token = self.request.META["HTTP_AUTHORIZATION"].split(' ')[-1] \
             if "HTTP_AUTHORIZATION" in self.request.META.keys() else None
         return token
 
-    def __remote_ip(self):
+    @cached_property
+    def remote_ip(self):
         """ get remote ip from the request """
         remote_ip = self.request.META[
             'HTTP_X_REAL_IP'] if 'HTTP_X_REAL_IP' in self.request.META \
             else self.request.META['REMOTE_ADDR']
         return remote_ip
 
-    def __request_method(self):
+    @cached_property
+    def request_method(self):
         """ get the request method """
         return self.request.method
 
-    def __project(self):
+    @cached_property
+    def project(self):
         """ get the project from the request args """
-        return self.request.REQUEST['project']
+        return request_args(self.request)['project']
 
-    def __source(self):
+    @cached_property
+    def source(self):
         """ get the source from the request args """
-        return self.request.REQUEST['establishment']
+        return request_args(self.request)['establishment']
 
     def __optionnal_args(self):
         "get all other args"
-        return {k:v for k,v in self.request.REQUEST.items()
+        return {k:v for k,v in request_args(self.request).items()
                 if k not in ['project','establishment']}
 
-    def __data(self):
+    @cached_property
+    def data(self):
         """ load data from responce content """
-        return json.loads(str(self.response.content, 'utf-8'))
+        return jsonbackend.loads(self.response.content)
 
-    def __signature(self):
+    @cached_property
+    def signature(self):
         """ build the excalibur signature with the user's token """
-        signkey = None
-        if self.token:
-            arguments_list = sorted(self.arguments)
-            to_hash = self.token
-            for argument in arguments_list:
-                to_hash += (argument + self.arguments[argument])
-            signkey = hashlib.sha1(to_hash.encode("utf-8")).hexdigest()
+        return sign(self.token, self.arguments)
 
-        return signkey
+    @cached_property
+    def timings(self):
+        """ the durations of the request steps, for the Server-Timing """
+        return ServerTiming(
+            getattr(settings, 'EXCALIBUR_SERVER_TIMING', False))
 
-    def make_and_run_query(self, plugin_runner, etab=None):
+    @cached_property
+    def partial(self):
+        """ the plugins skipped by their circuit breaker or failed """
+        return []
+
+    def make_query(self, etab=None, arguments=None, signature=None):
         """
-        make and run the query depending on etab
+        make the query depending on etab, for the request arguments or
+        other ones
         """
-        # create the query
         query = Query(
             source=etab if etab else self.source,
             remote_ip=self.remote_ip,
-            arguments=self.arguments,
+            arguments=arguments if arguments else self.arguments,
             ressource=self.ressource,
             method=self.method,
             request_method=self.request_method,
             project=self.project,
-            signature=self.signature
+            signature=signature if arguments else self.signature
         )
+        # the runner adds the plugins durations and skipped plugins
+        query.timings = self.timings
+        query.partial = self.partial
+        query.deadline = self.deadline
+        return query
+
+    def make_and_run_query(self, plugin_runner, etab=None):
+        """
+        make and run the query depending on etab
+        """
+        # create the query
+        query = self.make_query(etab)
 
         newdata, errors = plugin_runner(query)
 
         return newdata, errors
 
-    def manage_errors(self, errors):
-        """ manage errors """
-        # log each plugin's errors
+    def make_batch_query(self, id):
+        """ make the query of an id of the batch """
+        arguments = self.arguments_for(id)
+        return self.make_query(arguments=arguments,
+                               signature=sign(self.token, arguments))
+
+    def make_and_run_batch(self, plugin_runner):
+        """
+        make and run one query by id of the batch, at most
+        EXCALIBUR_BATCH_MAX_WORKERS at a time.
+        Return the data and errors by id, an excalibur error of a query is
+        an error of its id only.
+        """
+        def run(id):
+            query = self.make_batch_query(id)
+            try:
+                return plugin_runner(query)
+            except ExcaliburError as e:
+                return {}, {'excalibur': format_error(query, e, None)}
+
+        with ThreadPoolExecutor(max_workers=getattr(
+                settings, 'EXCALIBUR_BATCH_MAX_WORKERS', 4)) as executor:
+            results = list(executor.map(run, self.ids))
+
+        return collections.OrderedDict(zip(self.ids, results))
+
+    def log_errors(self, errors):
+        """ log each plugin's errors and return the last one """
         for plugin_name, err_par in errors.items():
             myerror = "error: %s:%s, plugin name: %s, source: %s, \
         ressource: %s, method: %s, arguments: %s, parameters index: %s" % (
@@ -164,88 +233,181 @@ class ExcaliburAttack():
 
             logger.warning(myerror)
 
+        return myerror
+
+    def manage_errors(self, errors):
+        """ manage errors, all of them are in the response """
+        myerror = self.log_errors(errors)
+
         return excalibur_exception_handler(ExcaliburError(myerror),
-                                           self.response)
+                                           self.response,
+                                           error_report(errors))
 
-    def aggregate_data(self, newdata):
+    def partial_errors(self, errors):
+        """
+        log the errors of the optional plugins and return their report,
+        the plugins are listed in the partial header
+        """
+        self.log_errors(errors)
+        self.partial.extend(errors)
+        return error_report(errors)
+
+    def aggregate_data(self, newdata, merge=None, errors=None):
         """
         Aggregate plugins data to camelot data.
         Priority for the referentiel data, except if the data is null,empty...
+        or if the merge options (strategy, precedence) say otherwise.
+        The errors of the optional plugins are reported in a dict.
         """
-        if newdata:
-
-            # aggregate in a dictionnary
-            if isinstance(self.data, dict):
-
-                # Remove not found message of referentiel if 404
-                if self.response.status_code == 404:
-                    self.response.status_code = 200
-                    if 'error' in self.data:
-                        del self.data['error']
-
-                # Aggregate data if not exists
-                for key, values in newdata.items():
-                    # update the new dict with data from referentiel
-                    if isinstance(values, dict):
-                        self.data.update(
-                            {k: v for k, v in values.items(
-                            ) if k not in self.data.keys()}
-                        )
-                    # if its a list or other, just add a new key named
-                    # like the plugin
-                    else:
-                        self.data.update({key: values})
-
-            # aggregate in a list
-            elif isinstance(self.data, list):
-                for values in newdata.values():
-                    # if the plugin return a list, merge the two lists
-                    if isinstance(values, list):
-                        self.data += values
-                    # if the plugin return something else, just append
-                    else:
-                        self.data.append(values)
-
-        self.response.content = json.dumps(self.data)
+        merge = merge or {}
+
+        # nothing to merge, keep the referentiel content as it is
+        if not newdata and not errors:
+            return self.response
+
+        report = self.partial_errors(errors) if errors else None
+
+        threshold = getattr(settings, 'EXCALIBUR_STREAMING_THRESHOLD', None)
+        if threshold is not None and \
+                len(self.response.content) >= threshold and \
+                jsonbackend.is_json_list(self.response.content):
+            return self.stream_list(newdata)
+
+        # aggregate in a dictionnary
+        if isinstance(self.data, dict):
+
+            # Remove not found message of referentiel if 404
+            if self.response.status_code == 404:
+                self.response.status_code = 200
+                if 'error' in self.data:
+                    del self.data['error']
+
+            # Aggregate data depending on the merge strategy
+            merge_dict(self.data, newdata, merge.get('strategy'),
+                       merge.get('precedence'))
+            if report:
+                self.data[ERRORS_KEY] = report
+
+        # aggregate in a list
+        elif isinstance(self.data, list):
+            merge_list(self.data, newdata)
+
+        self.response.content = jsonbackend.dumps(self.data)
+        self.measure_payload()
 
         return self.response
 
+    def aggregate_batch(self, results, merge=None):
+        """
+        Aggregate the plugins data of each id in the referentiel dict by id.
+        An id with errors gets its error message instead.
+        """
+        merge = merge or {}
+
+        if not isinstance(self.data, dict):
+            raise PluginRunnerError("a batch response must be a dict by id")
+
+        # Remove not found message of referentiel if 404
+        if self.response.status_code == 404:
+            self.response.status_code = 200
+            self.data.pop('error', None)
+
+        for id, (newdata, errors) in results.items():
+            if errors and not only_optional(errors):
+                self.data[id] = {'error': self.log_errors(errors)}
+            elif newdata or errors:
+                record = self.data.setdefault(id, {})
+                if isinstance(record, dict):
+                    merge_dict(record, newdata, merge.get('strategy'),
+                               merge.get('precedence'))
+                    if errors:
+                        record[ERRORS_KEY] = self.partial_errors(errors)
+                elif isinstance(record, list):
+                    merge_list(record, newdata)
+
+        self.response.content = jsonbackend.dumps(self.data)
+        self.measure_payload()
+
+        return self.response
+
+    def measure_payload(self):
+        """ record the size of the aggregated content """
+        metrics.size('excalibur.payload', len(self.response.content),
+                     ressource=self.ressource, method=self.method)
+
+    def stream_list(self, newdata):
+        """
+        Stream the referentiel list followed by the plugins items, like the
+        list aggregation but without decoding the referentiel content.
+        """
+        items = merge_list([], newdata)
+
+        response = StreamingHttpResponse(
+            jsonbackend.iter_json_list(self.response.content, items),
+            status=self.response.status_code)
+        for header, value in self.response.items():
+            if header.lower() != 'content-length':
+                response[header] = value
+
+        return response
+
     def get_request_user(self):
         """
-        get the user from the request
+        get the user from the request, reuse the token already resolved by
+        the rest framework authentication
         """
-        user = None
-        token = self.request.META["HTTP_AUTHORIZATION"].split(' ')[-1] \
-            if "HTTP_AUTHORIZATION" in self.request.META.keys() else None
+        if not self.token:
+            return None
 
-        if token:
-            try:
-                token = Token.objects.get(key=token)
-                if token.user:
-                    user = token.user
-            except ObjectDoesNotExist:
-                user = None
+        # never run the authentication from here
+        resolved = vars(self.request)
+        auth = resolved.get('auth', resolved.get('_auth'))
+        if isinstance(auth, Token) and auth.key == self.token:
+            return auth.user
+
+        return get_token_user(self.token)
+
+
+def only_optional(errors):
+    """ check if all the errors are errors of optional plugins """
+    return all(error.get('optional') for error in errors.values())
+
+
+def error_report(errors):
+    """ the errors of the plugins, by plugin """
+    return {plugin_name: {'error': error['error'],
+                          'error_message': error['error_message'],
+                          'source': error['source'],
+                          'parameters_index': error['parameters_index']}
+            for plugin_name, error in errors.items()}
+
+
+def sign(token, arguments):
+    """ build the excalibur signature of arguments with the user's token """
+    signkey = None
+    if token:
+        arguments_list = sorted(arguments)
+        to_hash = token
+        for argument in arguments_list:
+            to_hash += (argument + arguments[argument])
+        signkey = hashlib.sha1(to_hash.encode("utf-8")).hexdigest()
 
-        return user
+    return signkey
 
 
 def generate_client_and_get_data(spore, token, method_name, method_args):
     """
-    Generate a britney client and get data from method
+    Get a pooled britney client and get data from method
     """
 
-    client_name = hashlib.sha1(('%s%s' % (spore, token)).encode('utf-8')).hexdigest()
     data = None
 
-    try:
-        middlewares = (
-            (auth.ApiKey, {'key_name': 'Authorization',
-             'key_value': 'Token %s' % (token,)}),
-        )
+    # the deadline of the plugin, the client never waits longer
+    if expired():
+        raise DeadlineExceededError("no time left for %s" % method_name)
 
-        client = britney_utils.get_client(client_name,
-                                          spore,
-                                          middlewares=middlewares)
+    try:
+        client = get_client(spore, token)
 
         func = getattr(client, method_name)
         res = func(**method_args)
@@ -259,33 +421,131 @@ def generate_client_and_get_data(spore, token, method_name, method_args):
         return data
 
 
-def build_route_updates_data(users_list, project, establishment, member_label, member_code_key, base_url, reverse_name):
+def reverse_route(reverse_name, member_label, code):
+    """ reverse the route of a member code """
+    return reverse("%s" % reverse_name,
+                   kwargs={'memberskey': member_label, 'memberscode': code},
+                   format='json', request=None)
+
+
+def group_pattern(regex, name):
+    """ the regex of a named group of an url pattern, None if none """
+    group = '(?P<%s>' % name
+    start = regex.find(group)
+    if start == -1:
+        return None
+    index = begin = start + len(group)
+    depth, in_class = 1, False
+    while index < len(regex):
+        char = regex[index]
+        if char == '\\':
+            index += 2
+            continue
+        if in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if not depth:
+                return regex[begin:index]
+        index += 1
+    return None
+
+
+def code_pattern(reverse_name):
     """
-    build the updates route
+    the compiled regex of the member code in the url patterns of the
+    route, None if it is unknown or not the same in all the patterns
     """
+    names = reverse_name.split(':')
+    resolver = get_resolver(None)
+    try:
+        for namespace in names[:-1]:
+            resolver = resolver.namespace_dict[namespace][1]
+        possibilities = resolver.reverse_dict.getlist(names[-1])
+    except KeyError:
+        return None
+    patterns = set(group_pattern(possibility[1], 'memberscode')
+                   for possibility in possibilities)
+    if len(patterns) != 1 or None in patterns:
+        return None
+    return re.compile('(?:%s)\\Z' % patterns.pop())
+
+
+def route_template(url_reverse, code):
+    """
+    split the route of a member code around the code, the route of the
+    other codes matching the route pattern is then built without resolving
+    the url.
+    """
+    index = url_reverse.rfind(code)
+    return url_reverse[:index], url_reverse[index + len(code):]
 
-    res_list = []
 
+def iter_route_updates_data(users_list, project, establishment, member_label,
+                            member_code_key, base_url, reverse_name):
+    """
+    build the updates route of each user, one by one.
+    The users without code or route are logged once, at the end.
+    """
+    # the codes of the route pattern only are put in the template, the
+    # others are reversed to be skipped like before
+    pattern = code_pattern(reverse_name)
+    template, template_code = None, None
+    # the template is checked once against a real route
+    checked = False
+    url_args = "?establishment=%s&project=%s" % (establishment, project)
+    skipped = collections.Counter()
+    samples = {}
 
-    for result in users_list:
+    try:
+        for result in users_list:
+            try:
+                code = result[member_code_key]
+                # only the codes which are the same once quoted fit in the
+                # template
+                text = '%s' % code
+                fits = pattern is not None and SIMPLE_CODE.match(text) and \
+                    pattern.match(text)
+                if template and fits:
+                    url_reverse = template[0] + text + template[1]
+                    if not checked and text != template_code:
+                        checked = True
+                        url_check = reverse_route(reverse_name, member_label,
+                                                  code)
+                        if url_check != url_reverse:
+                            template = False
+                            url_reverse = url_check
+                else:
+                    url_reverse = reverse_route(reverse_name, member_label,
+                                                code)
+                    if template is None and fits:
+                        template = route_template(url_reverse, text)
+                        template_code = text
+
+                yield {'project': project,
+                       'establishment': establishment,
+                       'source': member_label, 'code': code,
+                       'url': "%s%s%s" % (base_url, url_reverse, url_args)}
+            except (KeyError, NoReverseMatch) as e:
+                skipped[e.__class__.__name__] += 1
+                samples.setdefault(e.__class__.__name__, str(e))
+    finally:
+        if skipped:
+            logger.critical("%s users skipped: %s" % (
+                sum(skipped.values()),
+                ", ".join("%s: %s (%s)" % (name, count, samples[name])
+                          for name, count in skipped.items())))
 
-        try:
-            url_reverse = reverse("%s" % reverse_name,
-                                  kwargs={'memberskey': member_label,
-                                          'memberscode': result[member_code_key]},
-                                  format='json', request=None)
-
-            url_args = "?establishment=%s&project=%s" % (establishment,
-                                                         project)
-            url = "%s%s%s" % (base_url, url_reverse, url_args)
-
-            res_list.append({'project': project,
-                             'establishment': establishment,
-                             'source': member_label, 'code': result[member_code_key],
-                             'url': url})
-        except KeyError as e:
-            logger.critical(str(e))
-        except NoReverseMatch as e:
-            logger.critical(str(e))
-
-    return res_list
+
+def build_route_updates_data(users_list, project, establishment, member_label, member_code_key, base_url, reverse_name):
+    """
+    build the updates route
+    """
+
+    return list(iter_route_updates_data(
+        users_list, project, establishment, member_label, member_code_key,
+        base_url, reverse_name))